@@ -1,40 +1,110 @@
-from fastapi import FastAPI, Request, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
-from fastapi.staticfiles import StaticFiles
+import time
+_IMPORT_START = time.perf_counter()
+
+from fastapi import FastAPI, Request, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi.responses import JSONResponse, HTMLResponse, Response, FileResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 
 import asyncio
 import numpy as np
 import base64
+import hashlib
+import hmac
+import json
 import os
-import time
+from collections import OrderedDict
 from datetime import datetime
 
 from database import (
     init_db,
-    log_prediction,
-    update_feedback,
     get_stats,
     get_history,
     export_csv,
     get_detailed_stats,
     get_model_performance,
+    get_model_version_stats,
+    get_predictions_by_ids,
+)
+
+from utils import (
+    load_pixels,
+    pixels_to_input,
+    softmax,
+    PredictionSmoother,
+    StartupProfile,
+    current_rss_mb,
+    current_pss_mb,
+)
+from model_registry import ModelRegistry
+from shared_state import SharedState, SharedPredictionSmoother
+from db_writer import InlineWriter
+from image_store import ImageStore, THUMB_DIR, digest_of
+from http_cache import (
+    IMMUTABLE,
+    REVALIDATE,
+    CompressionMiddleware,
+    FingerprintedStaticFiles,
+    etag_matches,
+    file_etag,
+    fingerprint,
 )
+from retention import load_policy, run_retention
+from embedding_index import VectorIndex, image_signature, SIGNATURE_GRID
+from traffic_recorder import TrafficRecorder
+from tiling import load_tiles, aggregate
 
-from utils import load_labels, preprocess_image, softmax, PredictionSmoother
+startup_profile = StartupProfile(started_at=_IMPORT_START)
+startup_profile.record("imports", _IMPORT_START)
 
 # ================= PATHS =================
 
 APP_ROOT = os.path.dirname(__file__)
 
+STATIC_DIR = os.path.join(APP_ROOT, "static")
+
 MODEL_PATH = os.path.join(APP_ROOT, "model", "tomato_mobilenet_int8.tflite")
+MODEL_REGISTRY_DIR = os.path.join(APP_ROOT, "model", "registry")
 LABELS_PATH = os.path.join(APP_ROOT, "labels.txt")
 PREDICTIONS_DIR = os.path.join(APP_ROOT, "predictions")
 DB_PATH = os.path.join(APP_ROOT, "predictions.db")
-
+ARCHIVE_DIR = os.path.join(APP_ROOT, "archive")
+EMBEDDINGS_DIR = os.path.join(APP_ROOT, "embeddings")
+RETENTION_POLICY_PATH = os.environ.get("RETENTION_POLICY", os.path.join(APP_ROOT, "retention.json"))
+# JSONL capture of every request for loadgen.py replay; unset disables recording
+TRAFFIC_LOG = os.environ.get("TRAFFIC_LOG")
+TRAFFIC_PAYLOAD_DIR = os.path.join(APP_ROOT, "traffic_payloads")
+
+# Version name used for the legacy MODEL_PATH when the registry is empty
 MODEL_VERSION = "v1.0-tflite-int8"
 
+MODEL_WATCH_INTERVAL = float(os.environ.get("MODEL_WATCH_INTERVAL", "5"))
+# Required in the X-Admin-Token header by /admin routes; unset disables them
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Load the model after startup so HTML routes serve while it loads; /ready
+# reports when inference is available.
+BACKGROUND_MODEL_LOAD = os.environ.get("BACKGROUND_MODEL_LOAD", "0") == "1"
+WARMUP_RUNS = int(os.environ.get("WARMUP_RUNS", "3"))
+# Seconds between retention passes (see retention.py); 0 disables them
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "0"))
+# Input-signature cosine similarity above which /predict reuses an earlier
+# result instead of invoking the model (e.g. 0.995); 0, the default, disables it
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", "0"))
+# Most recent predictions per worker that the check can reuse
+NEAR_DUPLICATE_WINDOW = int(os.environ.get("NEAR_DUPLICATE_WINDOW", "5000"))
+# Tiled mode (/predict?tiled=true): tile sides as fractions of the image's
+# short side, their overlap, and the most views (global one included) per request
+TILE_SCALES = tuple(float(v) for v in os.environ.get("TILE_SCALES", "0.5").split(","))
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", "0.25"))
+TILE_BUDGET = int(os.environ.get("TILE_BUDGET", "16"))
+# Also keep request bodies so a capture replays byte-for-byte
+TRAFFIC_PAYLOADS = os.environ.get("TRAFFIC_PAYLOADS", "0") == "1"
+TFLITE_NUM_THREADS = int(os.environ["TFLITE_NUM_THREADS"]) if os.environ.get("TFLITE_NUM_THREADS") else None
+# Keep weights in the shared memory-mapped model file instead of per-interpreter
+# delegate copies; trades latency for memory (see bench_memory.py)
+TFLITE_SHARE_WEIGHTS = os.environ.get("TFLITE_SHARE_WEIGHTS", "0") == "1"
+
 # ================= APP =================
 
 app = FastAPI()
@@ -47,184 +117,414 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(CompressionMiddleware)
+
+if TRAFFIC_LOG:
+    app.add_middleware(
+        TrafficRecorder,
+        path=TRAFFIC_LOG,
+        payload_dir=TRAFFIC_PAYLOAD_DIR if TRAFFIC_PAYLOADS else None,
+    )
+
 # Static folders
-app.mount("/static", StaticFiles(directory=os.path.join(APP_ROOT, "static")), name="static")
-app.mount("/predictions", StaticFiles(directory=PREDICTIONS_DIR), name="predictions")
+app.mount("/static", FingerprintedStaticFiles(directory=STATIC_DIR), name="static")
+image_store = ImageStore(PREDICTIONS_DIR)
 
 templates = Jinja2Templates(directory=os.path.join(APP_ROOT, "templates"))
 
+
+def static_url(path: str) -> str:
+    """Fingerprinted asset URL; served with a year-long immutable lifetime."""
+    return f"/static/{path}?v={fingerprint(os.path.join(STATIC_DIR, path))}"
+
+
+templates.env.globals["static_url"] = static_url
+
+# Boot id for data-version ETags: the counter restarts at 0 with the server
+_BOOT_ID = f"{int(time.time() * 1000):x}"
+
 # ================= GLOBALS =================
 
-interpreter = None
-input_details = None
-output_details = None
-labels = []
+registry = ModelRegistry(MODEL_REGISTRY_DIR, MODEL_PATH, LABELS_PATH, MODEL_VERSION,
+                         num_threads=TFLITE_NUM_THREADS, share_weights=TFLITE_SHARE_WEIGHTS)
+
+# The served model. Requests read this once and keep their handle, so a swap
+# never changes the interpreter under an in-flight request.
+current_model = None
 smoother = None
-DEMO_MODE = False
+
+# Replaced by serve.py before workers fork; see configure_workers()
+shared_state = SharedState()
+db_writer = None
+WORKERS = 1
+model_load_error = None
+_swap_lock = asyncio.Lock()
+# The event loop only keeps weak references to tasks; hold them here
+_background_tasks = set()
+
+# Per-worker shard files under EMBEDDINGS_DIR; see embedding_index.py
+signature_index = VectorIndex(EMBEDDINGS_DIR, "signature", SIGNATURE_GRID * SIGNATURE_GRID * 3)
+_embedding_indexes = {}
+# id -> (model version, probabilities) of this worker's recent predictions, so
+# a near-duplicate goes through the same path an invoke would have
+_recent_probs = OrderedDict()
+
+
+def configure_workers(state: SharedState, writer, workers: int):
+    """Called by serve.py in the parent process, before workers are forked."""
+    global shared_state, db_writer, WORKERS
+    shared_state = state
+    db_writer = writer
+    WORKERS = workers
+
+
+def _activate(model):
+    global current_model, model_load_error
+    current_model = model
+    model_load_error = None
+    # the first model to go live is when the server became ready
+    startup_profile.finish()
+    if smoother is not None:
+        # averaged probabilities from a different model are meaningless
+        smoother.reset()
+    # /stats reports the served model version, so cached copies are stale
+    shared_state.bump_data_version()
+
+
+async def swap_model(version: str, profile: StartupProfile | None = None):
+    """Load and warm `version` off the event loop, then make it the served model."""
+    async with _swap_lock:
+        if current_model is not None and current_model.version == version:
+            return current_model
+        loop = asyncio.get_running_loop()
+
+        def build():
+            if profile is None:
+                model = registry.load(version)
+                model.warm_up(WARMUP_RUNS)
+                return model
+            with profile.phase("model_load"):
+                model = registry.load(version)
+            with profile.phase("warm_up"):
+                model.warm_up(WARMUP_RUNS)
+            return model
+
+        model = await loop.run_in_executor(None, build)
+        _activate(model)
+        return model
+
+
+async def watch_registry():
+    """Pick up ACTIVE changes made by deploy scripts without a restart."""
+    while True:
+        await asyncio.sleep(MODEL_WATCH_INTERVAL)
+        version = None
+        try:
+            version = registry.active_version()
+            if current_model is None or version != current_model.version:
+                await swap_model(version)
+        except Exception as e:
+            print(f"Model watcher: could not activate {version}: {e}")
 
 
 # ================= STARTUP =================
 
+async def load_initial_model():
+    global model_load_error
+    try:
+        try:
+            await swap_model(registry.active_version(), startup_profile)
+        except KeyError:
+            # ACTIVE names a version that is not in the registry
+            await swap_model(MODEL_VERSION, startup_profile)
+    except Exception as e:
+        model_load_error = str(e)
+        raise
+    print(f"Model {current_model.version} ready in {startup_profile.total_ms} ms")
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
 @app.on_event("startup")
 async def startup_event():
-    global interpreter, input_details, output_details, labels, smoother, DEMO_MODE
+    global smoother, db_writer
 
-    os.makedirs(PREDICTIONS_DIR, exist_ok=True)
-    init_db(DB_PATH)
+    with startup_profile.phase("db_init"):
+        os.makedirs(PREDICTIONS_DIR, exist_ok=True)
+        init_db(DB_PATH)
 
-    labels = load_labels(LABELS_PATH)
+    if db_writer is None:
+        db_writer = InlineWriter(DB_PATH, shared_state)
+    if WORKERS > 1:
+        smoother = SharedPredictionSmoother(shared_state, window_size=5)
+    else:
+        smoother = PredictionSmoother(window_size=5)
+    if BACKGROUND_MODEL_LOAD:
+        _spawn(load_initial_model())
+    else:
+        await load_initial_model()
 
-    if not labels:
-        labels = ["Healthy", "Early_blight", "Late_blight"]
+    if MODEL_WATCH_INTERVAL > 0:
+        _spawn(watch_registry())
+    # serve.py runs retention in its own process when there are several workers
+    if RETENTION_INTERVAL > 0 and WORKERS == 1:
+        _spawn(retention_loop())
 
-    if not os.path.exists(MODEL_PATH):
-        DEMO_MODE = True
-        interpreter = None
-        input_details = {"shape": [1, 224, 224, 3], "dtype": np.float32, "index": 0}
-        output_details = {"index": 0, "quantization": (0.0, 0)}
 
-    else:
+async def retention_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(RETENTION_INTERVAL)
         try:
-            import tflite_runtime.interpreter as tflite_rt
-            Interpreter = tflite_rt.Interpreter
-        except:
-            from tensorflow.lite import Interpreter
+            result = await loop.run_in_executor(None, lambda: run_retention(
+                DB_PATH, PREDICTIONS_DIR, ARCHIVE_DIR, load_policy(RETENTION_POLICY_PATH),
+                shared_state.bump_data_version, embeddings_dir=EMBEDDINGS_DIR,
+            ))
+            print(f"Retention: {json.dumps(result)}")
+        except Exception as e:
+            print(f"Retention pass failed: {e}")
+
+
+def require_model():
+    """The served model, or 503 while the background load is still running."""
+    model = current_model
+    if model is None:
+        if model_load_error:
+            raise HTTPException(503, f"Model failed to load: {model_load_error}")
+        raise HTTPException(503, "Model is still loading", headers={"Retry-After": "1"})
+    return model
+
+
+@app.get("/ready")
+async def ready_probe():
+    """Readiness probe: 200 once the model is loaded and warmed, 503 before."""
+    body = {
+        "ready": current_model is not None,
+        "model_version": current_model.version if current_model else None,
+        "error": model_load_error,
+        "startup": startup_profile.as_dict(),
+    }
+    return JSONResponse(body, status_code=200 if current_model is not None else 503)
 
-        interpreter = Interpreter(model_path=MODEL_PATH)
-        interpreter.allocate_tensors()
-        input_details = interpreter.get_input_details()[0]
-        output_details = interpreter.get_output_details()[0]
 
-    smoother = PredictionSmoother(window_size=5)
+# ================= TEMPLATE ROUTES =================
 
+# The pages only vary by title and nav highlight; data is fetched client side.
+_rendered_pages = {}
+
+
+def render_page(request: Request, template: str, title: str, page: str) -> Response:
+    """Serve a page rendered once per worker, revalidated by ETag."""
+    rendered = _rendered_pages.get(template)
+    if rendered is None:
+        html = templates.get_template(template).render(title=title, page=page).encode("utf-8")
+        rendered = (html, f'"{hashlib.sha256(html).hexdigest()[:16]}"')
+        _rendered_pages[template] = rendered
+    html, etag = rendered
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(html, headers=headers)
 
-# ================= TEMPLATE ROUTES =================
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    return templates.TemplateResponse(
-        "index.html",
-        {"request": request, "title": "Tomato Detector", "page": "home"},
-    )
+    return render_page(request, "index.html", "Tomato Detector", "home")
 
 
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard_page(request: Request):
-    return templates.TemplateResponse(
-        "dashboard.html",
-        {"request": request, "title": "Dashboard", "page": "dashboard"},
-    )
+    return render_page(request, "dashboard.html", "Dashboard", "dashboard")
 
 
 @app.get("/history-page", response_class=HTMLResponse)
 async def history_page(request: Request):
-    return templates.TemplateResponse(
-        "history.html",
-        {"request": request, "title": "History", "page": "history"},
-    )
+    return render_page(request, "history.html", "History", "history")
 
 
 @app.get("/analytics", response_class=HTMLResponse)
 async def analytics_page(request: Request):
-    return templates.TemplateResponse(
-        "analytics.html",
-        {"request": request, "title": "Analytics", "page": "analytics"},
-    )
+    return render_page(request, "analytics.html", "Analytics", "analytics")
 
 
 @app.get("/model", response_class=HTMLResponse)
 async def model_page(request: Request):
-    return templates.TemplateResponse(
-        "model.html",
-        {"request": request, "title": "Model Info", "page": "model"},
-    )
+    return render_page(request, "model.html", "Model Info", "model")
 
 
 @app.get("/about", response_class=HTMLResponse)
 async def about_page(request: Request):
-    return templates.TemplateResponse(
-        "about.html",
-        {"request": request, "title": "About", "page": "about"},
-    )
+    return render_page(request, "about.html", "About", "about")
 
 
 # ================= INFERENCE =================
 
-async def run_inference(image_bytes: bytes):
-
-    start = time.perf_counter()
-
-    if DEMO_MODE or interpreter is None:
-        probs = softmax(np.random.rand(len(labels)))
-        return probs, (time.perf_counter() - start) * 1000
-
+def prepare_input(model, image_bytes: bytes):
+    """(resized RGB pixels, model input tensor); the pixels feed image_signature."""
+    input_details = model.input_details
     target_h = input_details["shape"][1]
     target_w = input_details["shape"][2]
     dtype = np.dtype(input_details["dtype"])
 
-    input_data = preprocess_image(
-        image_bytes,
-        target_size=(target_w, target_h),
-        dtype=dtype,
-        quantization=input_details.get("quantization", (0.0, 0)),
+    pixels = load_pixels(image_bytes, target_size=(target_w, target_h))
+    input_data = pixels_to_input(pixels, dtype, input_details.get("quantization", (0.0, 0)))
+    return pixels, np.expand_dims(input_data, axis=0)
+
+
+def embedding_index_for(model):
+    """Index of `model`'s feature vectors; vectors from different versions are not comparable."""
+    if model.embedding_dim is None:
+        return None
+    index = _embedding_indexes.get(model.version)
+    if index is None:
+        index = VectorIndex(EMBEDDINGS_DIR, f"embedding-{model.version}", model.embedding_dim, "int8")
+        _embedding_indexes[model.version] = index
+    return index
+
+
+def remember_probs(rec_id: int, model, probs: np.ndarray) -> None:
+    _recent_probs[rec_id] = (model.version, probs)
+    while len(_recent_probs) > NEAR_DUPLICATE_WINDOW:
+        _recent_probs.popitem(last=False)
+
+
+def find_near_duplicate(signature: np.ndarray, model):
+    """(id, probabilities) of this worker's recent prediction by `model` for an
+    (almost) identical input, or None."""
+    if NEAR_DUPLICATE_THRESHOLD <= 0:
+        return None
+    # other workers' rows are skipped: their probabilities are not kept here
+    hits = signature_index.search(signature, k=1, recent=NEAR_DUPLICATE_WINDOW, own_shard=True)
+    if not hits or hits[0][1] < NEAR_DUPLICATE_THRESHOLD:
+        return None
+    cached = _recent_probs.get(hits[0][0])
+    if cached is None or cached[0] != model.version:
+        return None
+    return hits[0][0], cached[1]
+
+
+def tiled_probs(model, image_bytes: bytes):
+    """Classify the global view and every tile in one batch; see tiling.py."""
+    input_details = model.input_details
+    size = (input_details["shape"][2], input_details["shape"][1])
+    pixels, boxes, image_size = load_tiles(image_bytes, size, TILE_SCALES, TILE_OVERLAP, TILE_BUDGET)
+    batch = pixels_to_input(
+        pixels,
+        np.dtype(input_details["dtype"]),
+        input_details.get("quantization", (0.0, 0)),
     )
+    outputs = model.invoke_batch(batch, pad_to=TILE_BUDGET)
+    probs, heatmap = aggregate(model.probabilities(outputs), boxes, image_size, model.labels)
+    return probs, heatmap, len(boxes)
+
+
+async def run_inference(image_bytes: bytes, tiled: bool = False) -> dict:
+    """Preprocess, reuse a near-duplicate's result if there is one, else invoke.
+
+    Returns `probs`, `inference_time` (ms) and `model`; real models also give
+    the input `signature`, the model `embedding` (None unless exported) and
+    `duplicate`, the earlier PredictionLog id when the invoke was skipped, in
+    which case `inference_time` is None.
+    Tiled runs skip the near-duplicate check and return `tiles` and `heatmap`.
+    """
+    start = time.perf_counter()
+    model = require_model()
+
+    if model.demo:
+        probs = softmax(np.random.rand(len(model.labels)))
+        return {"probs": probs, "inference_time": (time.perf_counter() - start) * 1000, "model": model}
 
     loop = asyncio.get_running_loop()
+    if tiled:
+        # decoding a 12 MP upload is too slow for the event loop
+        probs, heatmap, tiles = await loop.run_in_executor(None, tiled_probs, model, image_bytes)
+        return {"probs": probs, "inference_time": (time.perf_counter() - start) * 1000,
+                "model": model, "tiles": tiles, "heatmap": heatmap}
+
+    pixels, input_data = prepare_input(model, image_bytes)
+    signature = image_signature(pixels)
 
-    def invoke():
-        interpreter.set_tensor(input_details["index"], input_data)
-        interpreter.invoke()
-        output = interpreter.get_tensor(output_details["index"])
-        return output.reshape(-1).astype(np.float32)
+    duplicate = await loop.run_in_executor(None, find_near_duplicate, signature, model)
+    if duplicate is not None:
+        return {"probs": duplicate[1], "inference_time": None, "model": model,
+                "signature": signature, "duplicate": duplicate[0]}
 
-    output = await loop.run_in_executor(None, invoke)
+    output, embedding = await loop.run_in_executor(None, model.invoke_with_embedding, input_data)
 
-    probs = softmax(output)
+    probs = model.probabilities(output)
     inference_time = (time.perf_counter() - start) * 1000
 
-    return probs, inference_time
+    return {"probs": probs, "inference_time": inference_time, "model": model,
+            "signature": signature, "embedding": embedding, "duplicate": None}
 
 
 # ================= PREDICT =================
 
-@app.post("/predict")
-async def predict(file: UploadFile = File(...)):
-    content = await file.read()
-
-    probs, inference_time = await run_inference(content)
+async def predict_and_log(content: bytes, background_tasks: BackgroundTasks, tiled: bool = False):
+    """Shared body of /predict and /predict-frame."""
+    result = await run_inference(content, tiled)
+    model = result["model"]
+    inference_time = result["inference_time"]
+    duplicate = result.get("duplicate")
+    if duplicate is not None:
+        shared_state.incr("near_duplicates")
 
+    probs = result["probs"]
     idx = int(np.argmax(probs))
-    label = labels[idx]
+    label = model.labels[idx]
+    sm_label, sm_conf = smoother.update(probs, model.labels)
 
-    sm_label, sm_conf = smoother.update(probs, labels)
+    digest, image_path = image_store.put(content)
+    background_tasks.add_task(image_store.make_thumbnail, digest)
 
-    filename = f"pred_{int(time.time()*1000)}.jpg"
-    image_path = os.path.join(PREDICTIONS_DIR, filename)
-
-    with open(image_path, "wb") as f:
-        f.write(content)
-
-    rec_id = log_prediction(
-        DB_PATH,
+    rec_id = db_writer.log_prediction(
         image_path,
         label,
         float(sm_conf),
-        float(inference_time),
+        # NULL for reused results, so latency stats only count real invokes
+        float(inference_time) if inference_time is not None else None,
         datetime.utcnow(),
+        model.version,
     )
+    shared_state.incr("predictions")
+
+    if duplicate is None and result.get("signature") is not None:
+        signature_index.add(rec_id, result["signature"])
+        if NEAR_DUPLICATE_THRESHOLD > 0:
+            remember_probs(rec_id, model, probs)
+        if result.get("embedding") is not None:
+            embedding_index_for(model).add(rec_id, result["embedding"])
 
-    return JSONResponse({
+    body = {
         "id": rec_id,
         "disease": sm_label,
         "confidence": round(sm_conf * 100, 2),
-        "inference_time_ms": round(inference_time, 2),
-        "model_version": MODEL_VERSION,
+        "inference_time_ms": round(inference_time, 2) if inference_time is not None else None,
+        "model_version": model.version,
         "low_confidence": sm_conf < 0.4,
-    })
+    }
+    if duplicate is not None:
+        body["near_duplicate_of"] = duplicate
+    if "tiles" in result:
+        body["tiles"] = result["tiles"]
+        body["heatmap"] = result["heatmap"]
+    return JSONResponse(body)
+
+
+@app.post("/predict")
+async def predict(background_tasks: BackgroundTasks, file: UploadFile = File(...), tiled: bool = False):
+    """Classify an upload; `tiled=true` also looks at overlapping crops (see tiling.py)."""
+    content = await file.read()
+    return await predict_and_log(content, background_tasks, tiled)
 
 
 @app.post("/predict-frame")
-async def predict_frame(payload: dict):
+async def predict_frame(payload: dict, background_tasks: BackgroundTasks):
     """Predict from base64 encoded image frame (camera capture)."""
     try:
         frame_b64 = payload.get("frame")
@@ -236,42 +536,54 @@ async def predict_frame(payload: dict):
             frame_b64 = frame_b64.split(",", 1)[1]
         
         content = base64.b64decode(frame_b64)
-        probs, inference_time = await run_inference(content)
-
-        idx = int(np.argmax(probs))
-        label = labels[idx]
-
-        sm_label, sm_conf = smoother.update(probs, labels)
-
-        filename = f"pred_{int(time.time()*1000)}.jpg"
-        image_path = os.path.join(PREDICTIONS_DIR, filename)
-
-        with open(image_path, "wb") as f:
-            f.write(content)
-
-        rec_id = log_prediction(
-            DB_PATH,
-            image_path,
-            label,
-            float(sm_conf),
-            float(inference_time),
-            datetime.utcnow(),
-        )
-
-        return JSONResponse({
-            "id": rec_id,
-            "disease": sm_label,
-            "confidence": round(sm_conf * 100, 2),
-            "inference_time_ms": round(inference_time, 2),
-            "model_version": MODEL_VERSION,
-            "low_confidence": sm_conf < 0.4,
-        })
+        return await predict_and_log(content, background_tasks)
     except HTTPException:
         raise
     except Exception as e:
+        shared_state.incr("errors")
         raise HTTPException(500, str(e))
 
 
+@app.get("/similar/{pred_id}")
+async def similar_api(pred_id: int, k: int = 5):
+    """Past predictions whose images look most like prediction `pred_id`.
+
+    Uses the served model's embeddings when both predictions have one and
+    falls back to the input signatures otherwise.
+    """
+    k = max(1, min(k, 50))
+
+    def compute():
+        model = current_model
+        index = embedding_index_for(model) if model is not None else None
+        vector = index.vector_for(pred_id) if index is not None else None
+        method = "embedding"
+        if vector is None:
+            index, method = signature_index, "signature"
+            vector = index.vector_for(pred_id)
+        if vector is None:
+            return None
+        # over-fetch: archived rows are still in the index but not in the DB
+        hits = index.search(vector, k=k * 2, exclude=pred_id)
+        rows = get_predictions_by_ids(DB_PATH, [rec_id for rec_id, _ in hits])
+        similar = []
+        for rec_id, score in hits:
+            row = rows.get(rec_id)
+            if row is None:
+                continue
+            row["similarity"] = round(score, 4)
+            if row["image_path"]:
+                row["image_url"] = image_store.url_for(row["image_path"])
+                row["thumb_url"] = image_store.thumb_url_for(row["image_path"])
+            similar.append(row)
+        return {"id": pred_id, "method": method, "similar": similar[:k]}
+
+    result = await asyncio.get_running_loop().run_in_executor(None, compute)
+    if result is None:
+        raise HTTPException(404, f"prediction {pred_id} is not indexed")
+    return result
+
+
 # ================= FEEDBACK =================
 
 @app.post("/feedback/{pred_id}")
@@ -281,39 +593,87 @@ async def feedback(pred_id: int, payload: dict):
     if not true_label:
         raise HTTPException(400, "true_label required")
 
-    update_feedback(DB_PATH, pred_id, true_label, 1)
+    db_writer.update_feedback(pred_id, true_label, 1)
+    shared_state.incr("feedback")
+    # in multi-worker mode the update is queued; read it back once committed
+    committed = await db_writer.flush()
 
     stats = get_stats(DB_PATH)
-    return {"status": "ok", "accuracy": stats.get("accuracy")}
+    return {"status": "ok" if committed else "queued", "accuracy": stats.get("accuracy")}
 
 
 # ================= APIs =================
 
+def _cached_json(request: Request, slot: str, compute):
+    """JSON response served from the shared cache until the next DB write.
+
+    The ETag is the data version, so a poller that already has the current
+    payload gets a 304 without it being rebuilt or sent.
+    """
+    # read before computing: the payload is then at least as new as its tag
+    etag = f'"{slot}-{_BOOT_ID}-{shared_state.data_version.value}"'
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    payload = shared_state.cached(slot, lambda: json.dumps(compute()).encode("utf-8"))
+    return Response(payload, media_type="application/json", headers=headers)
+
+
 @app.get("/stats")
-async def stats_api():
-    s = get_stats(DB_PATH)
-    s["model_version"] = MODEL_VERSION
-    return s
+async def stats_api(request: Request, model_version: str | None = None):
+    def compute():
+        s = get_stats(DB_PATH, model_version)
+        s["model_version"] = current_model.version if current_model else None
+        return s
+
+    if model_version is not None:
+        return compute()
+    return _cached_json(request, "stats", compute)
+
+
+@app.get("/stats/by-model")
+async def stats_by_model_api():
+    """Prediction totals and accuracy split by the model version that served them"""
+    return get_model_version_stats(DB_PATH)
 
 
 @app.get("/detailed-stats")
-async def detailed_stats_api():
+async def detailed_stats_api(request: Request, model_version: str | None = None):
     """Get detailed analytics including class-wise accuracy and confidence breakdown"""
-    return get_detailed_stats(DB_PATH)
+    if model_version is not None:
+        return get_detailed_stats(DB_PATH, model_version)
+    return _cached_json(request, "detailed_stats", lambda: get_detailed_stats(DB_PATH))
 
 
 @app.get("/model-performance")
-async def model_performance_api():
+async def model_performance_api(request: Request, model_version: str | None = None):
     """Get comprehensive model performance metrics"""
-    return get_model_performance(DB_PATH)
+    if model_version is not None:
+        return get_model_performance(DB_PATH, model_version)
+    return _cached_json(request, "model_performance", lambda: get_model_performance(DB_PATH))
+
+
+@app.get("/metrics")
+async def metrics_api():
+    """Request counters shared by all worker processes"""
+    return {
+        "workers": WORKERS,
+        "pid": os.getpid(),
+        "data_version": shared_state.data_version.value,
+        "counters": shared_state.counters(),
+    }
 
 
 @app.get("/model-info")
 async def model_info_api():
     """Get model information and specifications"""
-    global interpreter, input_details, output_details, DEMO_MODE
+    model = require_model()
+    input_details = model.input_details
+    output_details = model.output_details
     
     input_shape = input_details.get("shape", [1, 224, 224, 3]) if input_details else [1, 224, 224, 3]
+    if isinstance(input_shape, np.ndarray):
+        input_shape = input_shape.tolist()
     quantized = False
     quant_scale = 0.0
     quant_zero_point = 0
@@ -325,24 +685,118 @@ async def model_info_api():
         quantized = quant_scale > 0
     
     return {
-        "model_version": MODEL_VERSION,
+        "model_version": model.version,
+        "loaded_at": datetime.utcfromtimestamp(model.loaded_at).isoformat(),
         "architecture": "MobileNetV2",
-        "format": "TensorFlow Lite (INT8 Quantized)",
+        "format": _model_format(model),
         "input_shape": input_shape,
         "quantized": quantized,
-        "quantization_scale": quant_scale,
-        "quantization_zero_point": quant_zero_point,
+        "quantization_scale": float(quant_scale),
+        "quantization_zero_point": int(quant_zero_point),
         "dataset": "PlantVillage Tomato Disease Dataset",
-        "classes": labels,
+        "classes": model.labels,
         "optimization": "Edge CPU Inference for Raspberry Pi 4",
-        "inference_engine": "TensorFlow Lite Runtime" if DEMO_MODE is False else "Demo Mode (Random)",
-        "demo_mode": DEMO_MODE
+        "inference_engine": "TensorFlow Lite Runtime" if not model.demo else "Demo Mode (Random)",
+        "demo_mode": model.demo,
+        "embedding_dim": model.embedding_dim,
+        "memory": {
+            **model.memory,
+            "process_rss_mb": _round_mb(current_rss_mb()),
+            "process_pss_mb": _round_mb(current_pss_mb()),
+        },
     }
 
 
+# quantization modes written to meta.json by convert_tflite.py
+_FORMAT_NAMES = {
+    "fp32": "Float32",
+    "fp16": "Float16 Weights",
+    "dynamic": "Dynamic-Range Quantized",
+    "int8": "INT8 Quantized",
+}
+
+
+def _model_format(model) -> str:
+    name = _FORMAT_NAMES.get(model.meta.get("quantization"))
+    if name is None:
+        integer_input = np.issubdtype(np.dtype(model.input_details["dtype"]), np.integer)
+        name = "INT8 Quantized" if integer_input else "Float"
+    return f"TensorFlow Lite ({name})"
+
+
+def _round_mb(value):
+    return round(value, 1) if value is not None else None
+
+
+# ================= MODEL ADMIN =================
+
+def _check_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(403, "admin API disabled: set ADMIN_TOKEN to enable it")
+    token = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(403, "admin token required")
+
+
+@app.get("/admin/models")
+async def list_models_api(request: Request):
+    _check_admin(request)
+    return {
+        "active": current_model.version if current_model else None,
+        "versions": registry.versions(),
+    }
+
+
+@app.post("/admin/models/{version}/activate")
+async def activate_model_api(version: str, request: Request):
+    """Load, warm and atomically switch to a registered model version."""
+    _check_admin(request)
+    try:
+        model = await swap_model(version)
+    except KeyError:
+        raise HTTPException(404, f"unknown model version {version}")
+    registry.set_active(version)
+    return {"status": "ok", "active": model.version}
+
+
 @app.get("/history")
-async def history_api():
-    return get_history(DB_PATH, limit=200)
+async def history_api(request: Request):
+    def compute():
+        rows = get_history(DB_PATH, limit=200)
+        for r in rows:
+            if r["image_path"]:
+                r["image_url"] = image_store.url_for(r["image_path"])
+                r["thumb_url"] = image_store.thumb_url_for(r["image_path"])
+        return rows
+
+    return _cached_json(request, "history", compute)
+
+
+@app.get("/predictions/{path:path}")
+async def prediction_image(path: str, request: Request):
+    """Stored originals and thumbnails with validators and cache lifetimes."""
+    full = os.path.realpath(os.path.join(PREDICTIONS_DIR, path))
+    if not full.startswith(os.path.realpath(PREDICTIONS_DIR) + os.sep):
+        raise HTTPException(404, "Not found")
+
+    digest = digest_of(full)
+    is_thumb = path.startswith(THUMB_DIR + "/")
+    if is_thumb and digest and not os.path.exists(full):
+        # the background job has not run yet (or the file was pruned)
+        await asyncio.get_running_loop().run_in_executor(None, image_store.make_thumbnail, digest)
+    if not os.path.isfile(full):
+        raise HTTPException(404, "Not found")
+
+    if digest:
+        etag = f'"{digest}{"-t" if is_thumb else ""}"'
+        cache_control = IMMUTABLE
+    else:
+        etag = file_etag(full)
+        cache_control = "public, max-age=86400"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(full, headers=headers)
 
 
 @app.get("/export/csv")
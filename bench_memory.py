@@ -0,0 +1,176 @@
+"""Measure model memory against interpreter count, with and without weight sharing.
+
+Two layouts are measured, each in fresh processes:
+
+    in-process   one process builds 1..N interpreters over the same file
+    workers      P processes build one interpreter each, like serve.py workers
+
+For every layout the default build (XNNPACK repacks weights privately) is
+compared with `share_weights` (kernels read the shared file mapping).  RSS
+counts shared pages once per process, so the worker layout is judged on
+summed PSS, which splits shared pages between their users.  Mean invoke
+latency is reported too, since sharing gives up the delegate's kernels.
+
+Usage:
+    python bench_memory.py
+    python bench_memory.py --model model/variants/tomato_mobilenet_fp32_224.tflite --interpreters 8 --processes 4
+"""
+import os
+import json
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from model_registry import build_interpreter
+from utils import current_rss_mb, current_pss_mb
+
+DEFAULT_MODEL = os.path.join("model", "tomato_mobilenet_int8.tflite")
+
+
+def _ready(path, threads, share_weights):
+    interpreter = build_interpreter(path, threads, share_weights)
+    interpreter.allocate_tensors()
+    detail = interpreter.get_input_details()[0]
+    interpreter.set_tensor(detail["index"], np.zeros(detail["shape"], dtype=detail["dtype"]))
+    interpreter.invoke()
+    return interpreter, detail
+
+
+def _latency_ms(interpreter, detail, runs):
+    dummy = np.zeros(detail["shape"], dtype=detail["dtype"])
+    start = time.perf_counter()
+    for _ in range(runs):
+        interpreter.set_tensor(detail["index"], dummy)
+        interpreter.invoke()
+    return (time.perf_counter() - start) * 1000 / runs
+
+
+def _in_process(path, count, threads, share_weights, runs, results):
+    rows = [{"interpreters": 0, "rss_mb": current_rss_mb(), "pss_mb": current_pss_mb()}]
+    kept = []
+    for i in range(count):
+        kept.append(_ready(path, threads, share_weights))
+        rows.append({"interpreters": i + 1, "rss_mb": current_rss_mb(), "pss_mb": current_pss_mb()})
+    results.put({"rows": rows, "latency_ms": _latency_ms(*kept[0], runs)})
+
+
+def _worker(path, threads, share_weights, runs, loaded, release, results):
+    baseline = current_pss_mb()
+    interpreter, detail = _ready(path, threads, share_weights)
+    latency = _latency_ms(interpreter, detail, runs)
+    results.put({"pid": os.getpid(), "baseline_pss_mb": baseline, "latency_ms": latency})
+    loaded.set()
+    # stay alive, with the interpreter mapped, until the parent has measured
+    release.wait()
+
+
+def _round_mb(value):
+    return round(value, 1) if value is not None else None
+
+
+def bench_in_process(ctx, path, count, threads, share_weights, runs):
+    results = ctx.Queue()
+    proc = ctx.Process(target=_in_process, args=(path, count, threads, share_weights, runs, results))
+    proc.start()
+    out = results.get()
+    proc.join()
+    rows = out["rows"]
+    base = rows[0]
+    for row in rows:
+        row["rss_delta_mb"] = round(row["rss_mb"] - base["rss_mb"], 1) if row["rss_mb"] is not None else None
+        row["pss_delta_mb"] = round(row["pss_mb"] - base["pss_mb"], 1) if row["pss_mb"] is not None else None
+    last = rows[-1]
+    return {
+        "rows": rows,
+        "per_interpreter_rss_mb": round(last["rss_delta_mb"] / count, 1) if last["rss_delta_mb"] is not None else None,
+        "latency_ms": round(out["latency_ms"], 3),
+    }
+
+
+def bench_workers(ctx, path, processes, threads, share_weights, runs):
+    results = ctx.Queue()
+    release = ctx.Event()
+    events = [ctx.Event() for _ in range(processes)]
+    procs = [ctx.Process(target=_worker, args=(path, threads, share_weights, runs, ev, release, results))
+             for ev in events]
+    for p in procs:
+        p.start()
+    for ev in events:
+        ev.wait()
+    reports = [results.get() for _ in procs]
+    # None as soon as one process can't be measured (off Linux)
+    pss = [current_pss_mb(r["pid"]) for r in reports]
+    rss = [current_rss_mb(r["pid"]) for r in reports]
+    baseline = [r["baseline_pss_mb"] for r in reports]
+    release.set()
+    for p in procs:
+        p.join()
+    total_pss = sum(pss) if None not in pss else None
+    total_rss = sum(rss) if None not in rss else None
+    model_pss = total_pss - sum(baseline) if total_pss is not None and None not in baseline else None
+    return {
+        "processes": processes,
+        "total_pss_mb": _round_mb(total_pss),
+        "total_rss_mb": _round_mb(total_rss),
+        "model_pss_mb": _round_mb(model_pss),
+        "per_worker_model_pss_mb": _round_mb(model_pss / processes if model_pss is not None else None),
+        "latency_ms": round(float(np.mean([r["latency_ms"] for r in reports])), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark model memory with and without shared weights")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--interpreters", type=int, default=6, help="interpreters in one process")
+    parser.add_argument("--processes", type=int, default=4, help="worker processes, one interpreter each")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=20, help="invokes for the latency figure")
+    parser.add_argument("--report", default=None, help="also write the results as JSON here")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        raise SystemExit(f"model not found: {args.model}")
+    if current_pss_mb() is None:
+        print("PSS and other processes' RSS are unavailable on this platform; "
+              "only the in-process RSS figures will be reported")
+
+    ctx = multiprocessing.get_context("spawn")
+    report = {"model": args.model, "file_mb": round(os.path.getsize(args.model) / (1024 * 1024), 2)}
+    for share in (False, True):
+        name = "shared" if share else "default"
+        print(f"[{name}] {args.interpreters} interpreters in one process...")
+        in_proc = bench_in_process(ctx, args.model, args.interpreters, args.threads, share, args.runs)
+        print(f"[{name}] {args.processes} worker processes...")
+        workers = bench_workers(ctx, args.model, args.processes, args.threads, share, args.runs)
+        report[name] = {"in_process": in_proc, "workers": workers}
+
+    lines = [
+        f"model {args.model} ({report['file_mb']} MB)",
+        "",
+        "| interpreters | default RSS +MB | shared RSS +MB |",
+        "|---|---|---|",
+    ]
+    for d, s in zip(report["default"]["in_process"]["rows"], report["shared"]["in_process"]["rows"]):
+        lines.append(f"| {d['interpreters']} | {d['rss_delta_mb']} | {s['rss_delta_mb']} |")
+    lines += [
+        "",
+        "| | default | shared |",
+        "|---|---|---|",
+    ]
+    for key, label in (("per_interpreter_rss_mb", "per interpreter, RSS MB"),):
+        lines.append(f"| {label} | {report['default']['in_process'][key]} | {report['shared']['in_process'][key]} |")
+    for key, label in (("per_worker_model_pss_mb", f"per worker of {args.processes}, PSS MB"),
+                       ("total_pss_mb", "all workers, total PSS MB"),
+                       ("latency_ms", "mean invoke, ms")):
+        lines.append(f"| {label} | {report['default']['workers'][key]} | {report['shared']['workers'][key]} |")
+    print("\n".join(lines))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
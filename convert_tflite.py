@@ -1,55 +1,303 @@
-import tensorflow as tf
-import numpy as np
+"""Build TFLite model variants and benchmark them on the local CPU.
+
+Every combination of quantization mode and input resolution is converted
+from the trained Keras model, then each artifact is benchmarked in a fresh
+process (latency, file size, peak memory) and scored on a held-out split from
+the dataset cache with the server's own preprocessing.  A comparison report is
+written next to the artifacts, and the fastest variant within the accuracy
+budget is published as a new version in the model registry (model_registry.py);
+--activate also makes it the served version.
+
+Usage:
+    python convert_tflite.py
+    python convert_tflite.py --quantizations int8 fp16 --resolutions 224 192
+    python convert_tflite.py --embedding    # also output pooled features
+    python convert_tflite.py --version v1.2-int8 --activate
+"""
 import os
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-
-def representative_dataset_gen():
-    dataset_path = 'dataset/train'
-    datagen = ImageDataGenerator(rescale=1.0/255.0)
-    
-    batch_size = 10
-    batch_count = 0
-    max_batches = 100
-    
-    for batch in datagen.flow_from_directory(
-        dataset_path,
-        target_size=(224, 224),
-        batch_size=batch_size,
-        class_mode='categorical',
-        shuffle=True
-    ):
-        if batch_count >= max_batches:
-            break
-        
-        yield [tf.convert_to_tensor(batch[0], dtype=tf.float32)]
-        batch_count += 1
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from dataset_cache import load_split, CachedSplit
+from utils import current_rss_mb, peak_rss_mb, pixels_to_input
+from model_registry import ModelRegistry
+
+QUANTIZATIONS = ("fp32", "fp16", "dynamic", "int8")
 
 model_path = 'model/tomato_model'
-output_tflite = 'model/tomato_mobilenet_int8.tflite'
-
-print(f"Loading SavedModel from {model_path}...")
-concrete_func = tf.saved_model.load(model_path).signatures[
-    tf.saved_model.DEFAULT_SERVING_SIGNATURE_DEF_KEY
-]
-
-def representative_data():
-    for data in representative_dataset_gen():
-        yield data
-
-print("Converting to TFLite with INT8 quantization...")
-converter = tf.lite.TFLiteConverter.from_saved_model(model_path)
-converter.optimizations = [tf.lite.Optimize.DEFAULT]
-converter.representative_dataset = representative_data
-converter.target_spec.supported_ops = [
-    tf.lite.OpsSet.TFLITE_BUILTINS_INT8
-]
-converter.inference_input_type = tf.uint8
-converter.inference_output_type = tf.uint8
-
-tflite_model = converter.convert()
-
-with open(output_tflite, 'wb') as f:
-    f.write(tflite_model)
-
-print(f"TFLite model saved to {output_tflite}")
-print(f"Model size: {len(tflite_model) / (1024 * 1024):.2f} MB")
+output_dir = 'model/variants'
+registry_dir = 'model/registry'
+labels_path = 'labels.txt'
+dataset_path = 'tomato'
+cache_path = 'dataset_cache'
+
+
+def representative_dataset_gen(resolution, samples):
+    import tensorflow as tf
+
+    # Same source as train.py; read from the memory-mapped cache
+    split = load_split(dataset_path, 'train', cache_dir=cache_path, image_size=224)
+
+    for images, _ in split.batches(1, shuffle=True, seed=0, limit=samples):
+        x = tf.convert_to_tensor(images.astype(np.float32) / 255.0, dtype=tf.float32)
+        if resolution != split.image_size:
+            x = tf.image.resize(x, (resolution, resolution))
+        yield [x]
+
+
+def with_embedding(model):
+    """`model` with its pooled features as a second output.
+
+    The server indexes that vector for similar-case lookups (embedding_index.py).
+    """
+    import tensorflow as tf
+
+    pooled = [l for l in model.layers if isinstance(l, tf.keras.layers.GlobalAveragePooling2D)]
+    if not pooled:
+        raise ValueError("model has no GlobalAveragePooling2D layer to expose as an embedding")
+    return tf.keras.Model(model.inputs, [model.output, pooled[-1].output])
+
+
+def convert_variant(model, quantization, resolution, calib_samples):
+    """Convert the Keras `model` for one (quantization, resolution) pair."""
+    import tensorflow as tf
+
+    @tf.function(input_signature=[tf.TensorSpec([1, resolution, resolution, 3], tf.float32)])
+    def serve(x):
+        return model(x, training=False)
+
+    # No trackable object: the converter then freezes the weights into
+    # constants.  With one, newer TensorFlow keeps them as resource variables,
+    # which int8 calibration cannot read.
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [serve.get_concrete_function()]
+    )
+
+    if quantization == "fp16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "dynamic":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == "int8":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: representative_dataset_gen(resolution, calib_samples)
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8
+        ]
+        converter.inference_input_type = tf.uint8
+        converter.inference_output_type = tf.uint8
+
+    return converter.convert()
+
+
+# ================= BENCHMARK =================
+
+def _prepare_input(images, resolution, detail):
+    """Same mapping the server applies (utils.preprocess_image), so accuracy is what serving gets."""
+    x = images.astype(np.float32)
+    if x.shape[1] != resolution:
+        from PIL import Image
+        x = np.stack([
+            np.asarray(Image.fromarray(img).resize((resolution, resolution), Image.BILINEAR),
+                       dtype=np.float32)
+            for img in images
+        ])
+    return pixels_to_input(x, np.dtype(detail["dtype"]), detail["quantization"])
+
+
+def _benchmark_worker(path, resolution, runs, threads, eval_split, eval_samples):
+    """Runs in a fresh process so peak memory is attributable to one model."""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+
+    baseline_rss = current_rss_mb()
+    interpreter = Interpreter(model_path=path, num_threads=threads)
+    interpreter.allocate_tensors()
+    input_detail = interpreter.get_input_details()[0]
+    # class scores are the narrowest output when an embedding is exported too
+    output_detail = min(interpreter.get_output_details(), key=lambda d: int(np.prod(d["shape"])))
+
+    dummy = np.zeros(input_detail["shape"], dtype=input_detail["dtype"])
+    for _ in range(5):
+        interpreter.set_tensor(input_detail["index"], dummy)
+        interpreter.invoke()
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        interpreter.set_tensor(input_detail["index"], dummy)
+        interpreter.invoke()
+        timings.append((time.perf_counter() - start) * 1000)
+    # sample before evaluation, which pages in the memmapped dataset shards
+    peak_rss = peak_rss_mb()
+
+    correct = evaluated = 0
+    if eval_split is not None:
+        split = CachedSplit(*eval_split)
+        for images, labels in split.batches(1, limit=eval_samples):
+            interpreter.set_tensor(input_detail["index"],
+                                   _prepare_input(images, resolution, input_detail))
+            interpreter.invoke()
+            out = interpreter.get_tensor(output_detail["index"]).reshape(-1)
+            correct += int(np.argmax(out) == int(labels[0]))
+            evaluated += 1
+
+    return {
+        "latency_ms_p50": round(float(np.percentile(timings, 50)), 3),
+        "latency_ms_p90": round(float(np.percentile(timings, 90)), 3),
+        "latency_ms_mean": round(float(np.mean(timings)), 3),
+        "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+        "model_rss_mb": round(peak_rss - baseline_rss, 1)
+        if peak_rss is not None and baseline_rss is not None else None,
+        "accuracy": round(correct / evaluated * 100, 2) if evaluated else None,
+        "evaluated": evaluated,
+    }
+
+
+def benchmark_variant(path, resolution, args, eval_split):
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(
+            _benchmark_worker,
+            (path, resolution, args.runs, args.threads, eval_split, args.eval_samples),
+        )
+
+
+def recommend(results, max_accuracy_drop):
+    """Fastest variant whose accuracy is within `max_accuracy_drop` points of the best."""
+    candidates = [r for r in results if "error" not in r]
+    if not candidates:
+        return None
+    scored = [r for r in candidates if r["accuracy"] is not None]
+    if scored:
+        best = max(r["accuracy"] for r in scored)
+        candidates = [r for r in scored if r["accuracy"] >= best - max_accuracy_drop]
+    return min(candidates, key=lambda r: (r["latency_ms_p50"], r["size_mb"]))
+
+
+def write_report(results, chosen, args):
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": {"platform": sys.platform, "cpu_count": os.cpu_count(), "threads": args.threads},
+        "max_accuracy_drop": args.max_accuracy_drop,
+        "embedding_output": args.embedding,
+        "recommended": chosen["name"] if chosen else None,
+        "variants": results,
+    }
+    with open(os.path.join(output_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    lines = [
+        "| variant | size (MB) | p50 (ms) | p90 (ms) | peak RSS (MB) | accuracy (%) |",
+        "|---|---|---|---|---|---|",
+    ]
+    for r in results:
+        if "error" in r:
+            lines.append(f"| {r['name']} | - | - | - | - | failed: {r['error']} |")
+            continue
+        mark = " **(recommended)**" if chosen and r["name"] == chosen["name"] else ""
+        lines.append(
+            f"| {r['name']}{mark} | {r['size_mb']} | {r['latency_ms_p50']} | {r['latency_ms_p90']} "
+            f"| {r['peak_rss_mb']} | {r['accuracy'] if r['accuracy'] is not None else 'n/a'} |"
+        )
+    with open(os.path.join(output_dir, "report.md"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n".join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and benchmark TFLite model variants")
+    parser.add_argument("--quantizations", nargs="+", choices=QUANTIZATIONS, default=list(QUANTIZATIONS))
+    parser.add_argument("--resolutions", nargs="+", type=int, default=[224, 160])
+    parser.add_argument("--calib-samples", type=int, default=300)
+    parser.add_argument("--eval-split", default=None, help="cached split to score on (default: test, else val)")
+    parser.add_argument("--eval-samples", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--max-accuracy-drop", type=float, default=1.0)
+    parser.add_argument("--embedding", action="store_true",
+                        help="add the pooled features as a second output for similar-case search")
+    parser.add_argument("--version", default=None,
+                        help="registry version name for the recommended variant "
+                             "(default: tflite-<variant>-<UTC timestamp>)")
+    parser.add_argument("--activate", action="store_true",
+                        help="also make the published version the served one")
+    args = parser.parse_args()
+
+    import tensorflow as tf
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    eval_split = None
+    for name in ([args.eval_split] if args.eval_split else ["test", "val"]):
+        try:
+            load_split(dataset_path, name, cache_dir=cache_path, image_size=224)
+        except FileNotFoundError:
+            continue
+        eval_split = (cache_path, name)
+        break
+    if eval_split is None:
+        print("No held-out split found in the dataset cache; accuracy will not be measured")
+
+    print(f"Loading Keras model from {model_path}...")
+    model = tf.keras.models.load_model(model_path)
+    if args.embedding:
+        model = with_embedding(model)
+
+    results = []
+    for resolution in args.resolutions:
+        for quantization in args.quantizations:
+            name = f"{quantization}_{resolution}"
+            path = os.path.join(output_dir, f"tomato_mobilenet_{name}.tflite")
+            print(f"Converting {name}...")
+            try:
+                tflite_model = convert_variant(model, quantization, resolution, args.calib_samples)
+            except Exception as e:
+                results.append({"name": name, "error": str(e)})
+                continue
+            with open(path, 'wb') as f:
+                f.write(tflite_model)
+
+            print(f"Benchmarking {name}...")
+            result = {
+                "name": name,
+                "path": path,
+                "quantization": quantization,
+                "resolution": resolution,
+                "size_mb": round(len(tflite_model) / (1024 * 1024), 2),
+            }
+            try:
+                result.update(benchmark_variant(path, resolution, args, eval_split))
+            except Exception as e:
+                result["error"] = str(e)
+            results.append(result)
+
+    chosen = recommend(results, args.max_accuracy_drop)
+    write_report(results, chosen, args)
+    if not chosen:
+        print("No variant converted and benchmarked cleanly; nothing published")
+        return
+
+    version = args.version or f"tflite-{chosen['name']}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}"
+    meta = {k: chosen[k] for k in ("name", "quantization", "resolution", "size_mb",
+                                   "latency_ms_p50", "accuracy", "evaluated")}
+    meta["embedding_output"] = args.embedding
+    registry = ModelRegistry(registry_dir, None, labels_path, None)
+    target = registry.publish(version, chosen["path"], labels_path, meta)
+    print(f"Recommended for serving: {chosen['name']}, published as {version} ({target})")
+    if args.activate:
+        registry.set_active(version)
+        print(f"{version} is now active; running servers switch to it on their next registry check")
+    else:
+        print(f"Activate with POST /admin/models/{version}/activate or by writing it to {registry.active_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,60 @@
 import sqlite3
 import csv
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+
+
+def _version_filter(model_version: Optional[str], keyword: str = "WHERE") -> Tuple[str, tuple]:
+    """SQL fragment restricting a query to one model version (or nothing)."""
+    if model_version is None:
+        return "", ()
+    return f" {keyword} model_version = ?", (model_version,)
+
+
+def _rows_source(model_version: Optional[str]) -> Tuple[str, tuple]:
+    """Raw PredictionLog rows and rolled-up PredictionDaily rows in one shape.
+
+    Each output row carries counts and sums (`n`, `sum_conf`, ...), so every
+    aggregate is a SUM over this source and stays correct after retention
+    has moved old rows into the daily summary.
+    """
+    where, params = _version_filter(model_version)
+    sql = '''(
+        SELECT model_version, predicted_label,
+               1 AS n,
+               confidence AS sum_conf,
+               COALESCE(inference_time, 0) AS sum_inf,
+               CASE WHEN inference_time IS NOT NULL THEN 1 ELSE 0 END AS timed,
+               inference_time AS min_inf,
+               inference_time AS max_inf,
+               CASE WHEN confidence >= 0.9 THEN 1 ELSE 0 END AS high,
+               CASE WHEN confidence >= 0.7 AND confidence < 0.9 THEN 1 ELSE 0 END AS medium,
+               CASE WHEN confidence < 0.7 THEN 1 ELSE 0 END AS low,
+               CASE WHEN is_correct IS NOT NULL THEN 1 ELSE 0 END AS fb,
+               CASE WHEN is_correct = 1 THEN 1 ELSE 0 END AS correct,
+               CASE WHEN is_correct IS NOT NULL THEN confidence ELSE 0 END AS fb_conf,
+               created_at AS first_seen,
+               created_at AS last_seen
+        FROM PredictionLog''' + where + '''
+        UNION ALL
+        SELECT NULLIF(model_version, ''), predicted_label,
+               total, sum_confidence, sum_inference_time, COALESCE(timed, total),
+               min_inference_time, max_inference_time,
+               conf_high, conf_medium, conf_low,
+               with_feedback, correct, feedback_sum_confidence,
+               first_seen, last_seen
+        FROM PredictionDaily''' + where + '''
+    )'''
+    return sql, params * 2
 
 
 def init_db(db_path: str):
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
+    # only takes effect on a new database; lets retention reclaim space in steps
+    cur.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL lets readers in other processes run while the writer commits
+    cur.execute('PRAGMA journal_mode=WAL')
     cur.execute('''
     CREATE TABLE IF NOT EXISTS PredictionLog(
         id INTEGER PRIMARY KEY,
@@ -19,23 +67,91 @@ def init_db(db_path: str):
         created_at TIMESTAMP
     )
     ''')
+    # databases created before the model registry lack this column
+    cols = [r[1] for r in cur.execute('PRAGMA table_info(PredictionLog)')]
+    if "model_version" not in cols:
+        cur.execute('ALTER TABLE PredictionLog ADD COLUMN model_version TEXT')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_predictionlog_created_at ON PredictionLog(created_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_predictionlog_image_path ON PredictionLog(image_path)')
+    # per-day rollups of rows removed by retention.py
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS PredictionDaily(
+        day TEXT NOT NULL,
+        model_version TEXT NOT NULL DEFAULT '',
+        predicted_label TEXT NOT NULL DEFAULT '',
+        total INTEGER,
+        sum_confidence REAL,
+        sum_inference_time REAL,
+        timed INTEGER,
+        min_inference_time REAL,
+        max_inference_time REAL,
+        conf_high INTEGER,
+        conf_medium INTEGER,
+        conf_low INTEGER,
+        with_feedback INTEGER,
+        correct INTEGER,
+        feedback_sum_confidence REAL,
+        first_seen TIMESTAMP,
+        last_seen TIMESTAMP,
+        PRIMARY KEY (day, model_version, predicted_label)
+    )
+    ''')
+    # rows with a NULL inference_time (reused near-duplicate results) are not
+    # counted in `timed`; older rollups predate those and had every row timed
+    cols = [r[1] for r in cur.execute('PRAGMA table_info(PredictionDaily)')]
+    if "timed" not in cols:
+        cur.execute('ALTER TABLE PredictionDaily ADD COLUMN timed INTEGER')
     conn.commit()
     conn.close()
 
 
-def log_prediction(db_path: str, image_path: str, predicted_label: str, confidence: float, inference_time: float, created_at: datetime) -> int:
+def log_prediction(db_path: str, image_path: str, predicted_label: str, confidence: float, inference_time: float, created_at: datetime, model_version: Optional[str] = None) -> int:
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
     cur.execute('''
-        INSERT INTO PredictionLog (image_path, predicted_label, confidence, true_label, is_correct, inference_time, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (image_path, predicted_label, confidence, None, None, inference_time, created_at.isoformat()))
+        INSERT INTO PredictionLog (image_path, predicted_label, confidence, true_label, is_correct, inference_time, created_at, model_version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (image_path, predicted_label, confidence, None, None, inference_time, created_at.isoformat(), model_version))
     conn.commit()
     rec_id = cur.lastrowid
     conn.close()
     return rec_id
 
 
+def write_batch(db_path: str, predictions: List[tuple], feedback: List[tuple]) -> List[tuple]:
+    """Apply queued writes in one transaction; returns the feedback rows that matched no row.
+
+    `predictions` rows are (id, image_path, predicted_label, confidence,
+    inference_time, created_at, model_version); `feedback` rows are
+    (id, true_label, is_correct).  Inserts run first so feedback on a row
+    queued in the same batch is not lost.
+    """
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.executemany('''
+        INSERT INTO PredictionLog (id, image_path, predicted_label, confidence, true_label, is_correct, inference_time, created_at, model_version)
+        VALUES (?, ?, ?, ?, NULL, NULL, ?, ?, ?)
+    ''', [(i, p, l, c, t, d.isoformat(), v) for i, p, l, c, t, d, v in predictions])
+    unmatched = []
+    for rec_id, label, ok in feedback:
+        cur.execute('UPDATE PredictionLog SET true_label = ?, is_correct = ? WHERE id = ?',
+                    (label, int(ok), rec_id))
+        if cur.rowcount == 0:
+            unmatched.append((rec_id, label, ok))
+    conn.commit()
+    conn.close()
+    return unmatched
+
+
+def get_max_id(db_path: str) -> int:
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute('SELECT MAX(id) FROM PredictionLog')
+    max_id = cur.fetchone()[0] or 0
+    conn.close()
+    return max_id
+
+
 def update_feedback(db_path: str, rec_id: int, true_label: str, is_correct: int):
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
@@ -49,28 +165,41 @@ def update_feedback(db_path: str, rec_id: int, true_label: str, is_correct: int)
 def get_history(db_path: str, limit: int = 100) -> List[Dict[str, Any]]:
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
-    cur.execute('SELECT id, image_path, predicted_label, confidence, true_label, is_correct, inference_time, created_at FROM PredictionLog ORDER BY created_at DESC LIMIT ?', (limit,))
+    cur.execute('SELECT id, image_path, predicted_label, confidence, true_label, is_correct, inference_time, created_at, model_version FROM PredictionLog ORDER BY created_at DESC LIMIT ?', (limit,))
     rows = cur.fetchall()
     conn.close()
-    cols = ["id", "image_path", "predicted_label", "confidence", "true_label", "is_correct", "inference_time", "created_at"]
+    cols = ["id", "image_path", "predicted_label", "confidence", "true_label", "is_correct", "inference_time", "created_at", "model_version"]
     return [dict(zip(cols, r)) for r in rows]
 
 
-def get_stats(db_path: str) -> Dict[str, Any]:
+def get_predictions_by_ids(db_path: str, ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """PredictionLog rows for `ids` keyed by id; archived or unknown ids are absent."""
+    if not ids:
+        return {}
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    marks = ",".join("?" * len(ids))
+    cur.execute('SELECT id, image_path, predicted_label, confidence, true_label, is_correct, inference_time, created_at, model_version FROM PredictionLog WHERE id IN (' + marks + ')', tuple(ids))
+    rows = cur.fetchall()
+    conn.close()
+    cols = ["id", "image_path", "predicted_label", "confidence", "true_label", "is_correct", "inference_time", "created_at", "model_version"]
+    return {r[0]: dict(zip(cols, r)) for r in rows}
+
+
+def get_stats(db_path: str, model_version: Optional[str] = None) -> Dict[str, Any]:
+    source, params = _rows_source(model_version)
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
-    cur.execute('SELECT COUNT(*) FROM PredictionLog')
-    total = cur.fetchone()[0]
-    cur.execute('SELECT AVG(confidence) FROM PredictionLog')
-    avg_conf = cur.fetchone()[0] or 0.0
-    cur.execute('SELECT SUM(is_correct), COUNT(is_correct) FROM PredictionLog WHERE is_correct IS NOT NULL')
+    cur.execute('SELECT SUM(n), SUM(sum_conf), SUM(correct), SUM(fb) FROM ' + source, params)
     row = cur.fetchone()
-    correct = row[0] or 0
-    counted = row[1] or 0
+    total = row[0] or 0
+    avg_conf = (row[1] / total) if total and row[1] is not None else 0.0
+    correct = row[2] or 0
+    counted = row[3] or 0
     accuracy = (correct / counted * 100.0) if counted > 0 else None
 
     # class distribution
-    cur.execute('SELECT predicted_label, COUNT(*) FROM PredictionLog GROUP BY predicted_label')
+    cur.execute('SELECT predicted_label, SUM(n) FROM ' + source + ' GROUP BY predicted_label', params)
     dist = {r[0]: r[1] for r in cur.fetchall()}
 
     # health score heuristic: accuracy weighted and avg confidence
@@ -89,29 +218,38 @@ def get_stats(db_path: str) -> Dict[str, Any]:
     }
 
 
-def get_detailed_stats(db_path: str) -> Dict[str, Any]:
+def get_detailed_stats(db_path: str, model_version: Optional[str] = None) -> Dict[str, Any]:
     """Get comprehensive analytics including class-wise accuracy and confidence breakdown"""
+    source, params = _rows_source(model_version)
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
     
-    # Total with feedback
-    cur.execute('SELECT COUNT(*) FROM PredictionLog WHERE true_label IS NOT NULL')
-    total_with_feedback = cur.fetchone()[0]
+    # Totals, inference time stats and confidence distribution
+    cur.execute('''
+        SELECT SUM(fb), MIN(min_inf), MAX(max_inf), SUM(sum_inf), SUM(timed),
+               SUM(high), SUM(medium), SUM(low)
+        FROM ''' + source, params)
+    row = cur.fetchone()
+    total_with_feedback = row[0] or 0
+    min_inf = row[1] or 0
+    max_inf = row[2] or 0
+    avg_inf = (row[3] / row[4]) if row[4] else 0
+    conf_row = row[5:8]
     
     # Class-wise accuracy
     cur.execute('''
         SELECT predicted_label, 
-               COUNT(*) as total,
-               SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) as correct,
-               AVG(confidence) as avg_conf
-        FROM PredictionLog 
-        WHERE true_label IS NOT NULL
+               SUM(fb) as total,
+               SUM(correct) as correct,
+               SUM(fb_conf) as sum_conf
+        FROM ''' + source + '''
         GROUP BY predicted_label
+        HAVING SUM(fb) > 0
         ORDER BY total DESC
-    ''')
+    ''', params)
     class_stats = []
     for row in cur.fetchall():
-        class_name, total, correct, avg_conf = row
+        class_name, total, correct, sum_conf = row
         correct = correct or 0
         accuracy = (correct / total * 100) if total > 0 else 0
         class_stats.append({
@@ -119,26 +257,9 @@ def get_detailed_stats(db_path: str) -> Dict[str, Any]:
             "total": total,
             "correct": correct,
             "accuracy": round(accuracy, 2),
-            "avg_confidence": round(avg_conf or 0, 4)
+            "avg_confidence": round((sum_conf or 0) / total, 4)
         })
     
-    # Inference time stats
-    cur.execute('SELECT MIN(inference_time), MAX(inference_time), AVG(inference_time) FROM PredictionLog')
-    inf_row = cur.fetchone()
-    min_inf = inf_row[0] or 0
-    max_inf = inf_row[1] or 0
-    avg_inf = inf_row[2] or 0
-    
-    # Confidence distribution
-    cur.execute('''
-        SELECT 
-            SUM(CASE WHEN confidence >= 0.9 THEN 1 ELSE 0 END) as high,
-            SUM(CASE WHEN confidence >= 0.7 AND confidence < 0.9 THEN 1 ELSE 0 END) as medium,
-            SUM(CASE WHEN confidence < 0.7 THEN 1 ELSE 0 END) as low
-        FROM PredictionLog
-    ''')
-    conf_row = cur.fetchone()
-    
     conn.close()
     return {
         "summary": {
@@ -158,27 +279,22 @@ def get_detailed_stats(db_path: str) -> Dict[str, Any]:
     }
 
 
-def get_model_performance(db_path: str) -> Dict[str, Any]:
+def get_model_performance(db_path: str, model_version: Optional[str] = None) -> Dict[str, Any]:
     """Get model performance metrics"""
+    source, params = _rows_source(model_version)
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
     
-    cur.execute('SELECT COUNT(*) FROM PredictionLog')
-    total_predictions = cur.fetchone()[0]
-    
-    cur.execute('SELECT COUNT(*) FROM PredictionLog WHERE true_label IS NOT NULL')
-    predictions_with_feedback = cur.fetchone()[0]
-    
-    cur.execute('SELECT COUNT(*) FROM PredictionLog WHERE is_correct = 1')
-    correct_predictions = cur.fetchone()[0]
+    cur.execute('SELECT SUM(n), SUM(fb), SUM(correct), SUM(sum_conf), SUM(sum_inf), SUM(timed) FROM ' + source, params)
+    row = cur.fetchone()
+    total_predictions = row[0] or 0
+    predictions_with_feedback = row[1] or 0
+    correct_predictions = row[2] or 0
     
     accuracy = (correct_predictions / predictions_with_feedback * 100) if predictions_with_feedback > 0 else 0
     
-    cur.execute('SELECT AVG(confidence) FROM PredictionLog')
-    avg_confidence = cur.fetchone()[0] or 0
-    
-    cur.execute('SELECT AVG(inference_time) FROM PredictionLog')
-    avg_inference_time = cur.fetchone()[0] or 0
+    avg_confidence = (row[3] or 0) / total_predictions if total_predictions else 0
+    avg_inference_time = (row[4] or 0) / row[5] if row[5] else 0
     
     conn.close()
     return {
@@ -192,12 +308,48 @@ def get_model_performance(db_path: str) -> Dict[str, Any]:
     }
 
 
+def get_model_version_stats(db_path: str) -> List[Dict[str, Any]]:
+    """Per-model-version totals so a new model can be compared with the old one"""
+    source, params = _rows_source(None)
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT model_version,
+               SUM(n),
+               SUM(fb),
+               SUM(correct),
+               SUM(sum_conf),
+               SUM(sum_inf),
+               SUM(timed),
+               MIN(first_seen),
+               MAX(last_seen)
+        FROM ''' + source + '''
+        GROUP BY model_version
+        ORDER BY MIN(first_seen)
+    ''', params)
+    out = []
+    for version, total, with_feedback, correct, sum_conf, sum_inf, timed, first, last in cur.fetchall():
+        with_feedback = with_feedback or 0
+        out.append({
+            "model_version": version,
+            "total_predictions": total,
+            "predictions_with_feedback": with_feedback,
+            "accuracy_percent": round((correct or 0) / with_feedback * 100, 2) if with_feedback else None,
+            "avg_confidence_percent": round((sum_conf or 0) / total * 100, 2),
+            "avg_inference_time_ms": round((sum_inf or 0) / timed, 2) if timed else 0,
+            "first_seen": first,
+            "last_seen": last,
+        })
+    conn.close()
+    return out
+
+
 def export_csv(db_path: str) -> str:
     rows = get_history(db_path, limit=10000)
     if not rows:
         return ""
     output = []
-    header = ["id", "image_path", "predicted_label", "confidence", "true_label", "is_correct", "inference_time", "created_at"]
+    header = ["id", "image_path", "predicted_label", "confidence", "true_label", "is_correct", "inference_time", "created_at", "model_version"]
     output.append(header)
     for r in rows:
         output.append([r.get(c) for c in header])
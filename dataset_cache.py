@@ -0,0 +1,287 @@
+"""Compile an image-folder dataset into memory-mappable shards.
+
+`train.py`, `convert_tflite.py` and the offline evaluation tooling used to walk
+the dataset directory and decode every JPEG on each run.  This module does the
+decode/resize once and writes, per split:
+
+    <cache_dir>/<split>/manifest.json     class names, image size, per-file hashes
+    <cache_dir>/<split>/images_00000.npy  uint8 array (N, H, W, 3)
+    <cache_dir>/<split>/labels_00000.npy  int16 array (N,)
+
+Shards are plain `.npy` files, so readers open them with `np.load(mmap_mode="r")`
+and slice batches straight out of the page cache.  Rebuilding is incremental:
+unchanged files (same size and mtime, or same content hash) are copied from the
+previous shards instead of being decoded again.
+
+Usage:
+    python dataset_cache.py tomato --splits train val
+"""
+import os
+import json
+import hashlib
+import argparse
+from typing import Dict, List, Tuple, Iterator
+
+import numpy as np
+from PIL import Image
+
+
+CACHE_FORMAT_VERSION = 1
+DEFAULT_CACHE_DIR = "dataset_cache"
+DEFAULT_SHARD_SIZE = 1024
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _scan_source(split_dir: str) -> Tuple[List[str], List[Tuple[str, int]]]:
+    """Return (class_names, [(relative_path, class_index), ...]) sorted like Keras."""
+    class_names = sorted(
+        d for d in os.listdir(split_dir)
+        if os.path.isdir(os.path.join(split_dir, d))
+    )
+    files = []
+    for idx, name in enumerate(class_names):
+        class_dir = os.path.join(split_dir, name)
+        for root, _, filenames in os.walk(class_dir):
+            for fn in sorted(filenames):
+                if fn.lower().endswith(IMAGE_EXTENSIONS):
+                    rel = os.path.relpath(os.path.join(root, fn), split_dir)
+                    files.append((rel.replace(os.sep, "/"), idx))
+    files.sort()
+    return class_names, files
+
+
+def _decode(path: str, image_size: int) -> np.ndarray:
+    with Image.open(path) as img:
+        img = img.convert("RGB").resize((image_size, image_size), Image.BILINEAR)
+        return np.asarray(img, dtype=np.uint8)
+
+
+def _load_manifest(split_cache: str) -> Dict:
+    path = os.path.join(split_cache, "manifest.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compile_split(source_dir: str,
+                  split: str,
+                  cache_dir: str = DEFAULT_CACHE_DIR,
+                  image_size: int = 224,
+                  shard_size: int = DEFAULT_SHARD_SIZE) -> Dict:
+    """Compile `<source_dir>/<split>` into `<cache_dir>/<split>`.
+
+    Returns the written manifest.  If nothing changed since the last build the
+    existing manifest is returned without touching the shards.
+    """
+    split_dir = os.path.join(source_dir, split)
+    split_cache = os.path.join(cache_dir, split)
+    os.makedirs(split_cache, exist_ok=True)
+
+    class_names, files = _scan_source(split_dir)
+    old = _load_manifest(split_cache)
+    old_ok = (
+        old.get("format_version") == CACHE_FORMAT_VERSION
+        and old.get("image_size") == image_size
+    )
+    old_by_path = {e["path"]: e for e in old.get("files", [])} if old_ok else {}
+    old_by_hash = {e["sha256"]: e for e in old.get("files", [])} if old_ok else {}
+
+    # Hash only the files whose size/mtime changed since the last build.
+    entries = []
+    for rel, label in files:
+        full = os.path.join(split_dir, rel)
+        st = os.stat(full)
+        prev = old_by_path.get(rel)
+        if prev and prev["size"] == st.st_size and prev["mtime_ns"] == st.st_mtime_ns:
+            digest = prev["sha256"]
+        else:
+            digest = _file_sha256(full)
+        entries.append({
+            "path": rel,
+            "label": label,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": digest,
+        })
+
+    if (old_ok
+            and old.get("class_names") == class_names
+            and old.get("shard_size") == shard_size
+            and [(e["path"], e["sha256"], e["label"]) for e in old["files"]]
+            == [(e["path"], e["sha256"], e["label"]) for e in entries]):
+        return old
+
+    old_shards = {}
+
+    def old_row(entry):
+        shard = entry["shard"]
+        if shard not in old_shards:
+            old_shards[shard] = np.load(
+                os.path.join(split_cache, f"images_{shard:05d}.npy"), mmap_mode="r"
+            )
+        return np.array(old_shards[shard][entry["row"]])
+
+    # Write new shards to temporary names first; the old shards stay readable
+    # until the new manifest replaces them.
+    reused = decoded = 0
+    shard_names = []
+    for shard, start in enumerate(range(0, len(entries), shard_size)):
+        chunk = entries[start:start + shard_size]
+        images = np.empty((len(chunk), image_size, image_size, 3), dtype=np.uint8)
+        labels = np.empty((len(chunk),), dtype=np.int16)
+        for row, entry in enumerate(chunk):
+            prev = old_by_hash.get(entry["sha256"])
+            if prev is not None:
+                images[row] = old_row(prev)
+                reused += 1
+            else:
+                images[row] = _decode(os.path.join(split_dir, entry["path"]), image_size)
+                decoded += 1
+            labels[row] = entry["label"]
+            entry["shard"] = shard
+            entry["row"] = row
+        np.save(os.path.join(split_cache, f"images_{shard:05d}.tmp.npy"), images)
+        np.save(os.path.join(split_cache, f"labels_{shard:05d}.tmp.npy"), labels)
+        shard_names.append(shard)
+    old_shards.clear()
+
+    for shard in shard_names:
+        for kind in ("images", "labels"):
+            os.replace(
+                os.path.join(split_cache, f"{kind}_{shard:05d}.tmp.npy"),
+                os.path.join(split_cache, f"{kind}_{shard:05d}.npy"),
+            )
+    for shard in range(len(shard_names), old.get("num_shards", 0) if old_ok else 0):
+        for kind in ("images", "labels"):
+            stale = os.path.join(split_cache, f"{kind}_{shard:05d}.npy")
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    manifest = {
+        "format_version": CACHE_FORMAT_VERSION,
+        "source": os.path.abspath(split_dir),
+        "image_size": image_size,
+        "shard_size": shard_size,
+        "num_shards": len(shard_names),
+        "num_images": len(entries),
+        "class_names": class_names,
+        "files": entries,
+    }
+    tmp = os.path.join(split_cache, "manifest.json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(split_cache, "manifest.json"))
+
+    print(f"[{split}] {len(entries)} images: {decoded} decoded, {reused} reused")
+    return manifest
+
+
+class CachedSplit:
+    """Read-only, memory-mapped view of one compiled split."""
+
+    def __init__(self, cache_dir: str, split: str):
+        self.path = os.path.join(cache_dir, split)
+        self.manifest = _load_manifest(self.path)
+        if not self.manifest:
+            raise FileNotFoundError(f"No dataset cache at {self.path}")
+        self.class_names: List[str] = self.manifest["class_names"]
+        self.image_size: int = self.manifest["image_size"]
+        self._images = [
+            np.load(os.path.join(self.path, f"images_{i:05d}.npy"), mmap_mode="r")
+            for i in range(self.manifest["num_shards"])
+        ]
+        self.labels = np.concatenate([
+            np.load(os.path.join(self.path, f"labels_{i:05d}.npy"))
+            for i in range(self.manifest["num_shards"])
+        ]) if self._images else np.empty((0,), dtype=np.int16)
+        self._shard_size = self.manifest["shard_size"]
+
+    @property
+    def num_classes(self) -> int:
+        return len(self.class_names)
+
+    def __len__(self) -> int:
+        return int(self.labels.shape[0])
+
+    def images(self, indices) -> np.ndarray:
+        """Gather uint8 images for `indices` (any order) into one array."""
+        indices = np.asarray(indices, dtype=np.int64)
+        out = np.empty((len(indices), self.image_size, self.image_size, 3), dtype=np.uint8)
+        shards, rows = np.divmod(indices, self._shard_size)
+        for shard in np.unique(shards):
+            sel = np.flatnonzero(shards == shard)
+            # memmap fancy indexing is fastest with ascending rows
+            order = np.argsort(rows[sel], kind="stable")
+            out[sel[order]] = self._images[shard][rows[sel][order]]
+        return out
+
+    def shard_views(self) -> List[np.ndarray]:
+        """The memory-mapped shards themselves, for sequential zero-copy reads."""
+        return list(self._images)
+
+    def batches(self,
+                batch_size: int,
+                shuffle: bool = False,
+                seed: int | None = None,
+                limit: int | None = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield (uint8 images, int labels) batches.
+
+        Without shuffling, batches are slices of the mapped shards (no copy).
+        """
+        n = len(self) if limit is None else min(limit, len(self))
+        if shuffle:
+            order = np.random.default_rng(seed).permutation(len(self))[:n]
+            for start in range(0, n, batch_size):
+                idx = order[start:start + batch_size]
+                yield self.images(idx), self.labels[idx]
+            return
+        done = 0
+        for shard, images in enumerate(self._images):
+            base = shard * self._shard_size
+            for start in range(0, images.shape[0], batch_size):
+                if done >= n:
+                    return
+                stop = min(start + batch_size, images.shape[0], start + n - done)
+                yield images[start:stop], self.labels[base + start:base + stop]
+                done += stop - start
+
+
+def load_split(source_dir: str,
+               split: str,
+               cache_dir: str = DEFAULT_CACHE_DIR,
+               image_size: int = 224,
+               rebuild: bool = True) -> CachedSplit:
+    """Open a compiled split, (re)building it first if sources changed."""
+    if rebuild and os.path.isdir(os.path.join(source_dir, split)):
+        compile_split(source_dir, split, cache_dir=cache_dir, image_size=image_size)
+    return CachedSplit(cache_dir, split)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile dataset into memory-mapped shards")
+    parser.add_argument("source", nargs="?", default="tomato", help="dataset root with one folder per split")
+    parser.add_argument("--splits", nargs="+", default=["train", "val"])
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--image-size", type=int, default=224)
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE)
+    args = parser.parse_args()
+
+    for split in args.splits:
+        if not os.path.isdir(os.path.join(args.source, split)):
+            print(f"[{split}] skipped: {os.path.join(args.source, split)} not found")
+            continue
+        compile_split(args.source, split, cache_dir=args.cache_dir,
+                      image_size=args.image_size, shard_size=args.shard_size)
+
+
+if __name__ == "__main__":
+    main()
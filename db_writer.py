@@ -0,0 +1,174 @@
+"""PredictionLog writers for single- and multi-process serving.
+
+`InlineWriter` writes from the serving process itself, as the app always did.
+`QueueWriter` is what workers use under serve.py: ids come from a shared
+counter so the response can be sent immediately, and the rows travel over a
+queue to the one process running `run_writer`, which commits them in batches.
+"""
+import asyncio
+import signal
+import queue as queue_module
+import time
+from datetime import datetime
+from typing import Optional
+
+from database import log_prediction, update_feedback, write_batch
+from shared_state import SharedState
+
+
+class InlineWriter:
+    def __init__(self, db_path: str, state: SharedState):
+        self.db_path = db_path
+        self.state = state
+
+    def log_prediction(self, image_path: str, predicted_label: str, confidence: float,
+                       inference_time: float, created_at: datetime,
+                       model_version: Optional[str] = None) -> int:
+        rec_id = log_prediction(self.db_path, image_path, predicted_label, confidence,
+                                inference_time, created_at, model_version)
+        self.state.bump_data_version()
+        return rec_id
+
+    def update_feedback(self, rec_id: int, true_label: str, is_correct: int) -> None:
+        update_feedback(self.db_path, rec_id, true_label, is_correct)
+        self.state.bump_data_version()
+
+    async def flush(self, timeout: float = 2.0) -> bool:
+        return True
+
+
+class QueueWriter:
+    def __init__(self, queue, state: SharedState, worker_index: int = 0):
+        self.queue = queue
+        self.state = state
+        self.worker_index = worker_index
+        self._seq = 0
+
+    def _put(self, kind: str, row: tuple) -> None:
+        self._seq += 1
+        self.queue.put((kind, self.worker_index, self._seq, row))
+
+    def log_prediction(self, image_path: str, predicted_label: str, confidence: float,
+                       inference_time: float, created_at: datetime,
+                       model_version: Optional[str] = None) -> int:
+        rec_id = self.state.allocate_id()
+        self._put("prediction", (rec_id, image_path, predicted_label, confidence,
+                                 inference_time, created_at, model_version))
+        return rec_id
+
+    def update_feedback(self, rec_id: int, true_label: str, is_correct: int) -> None:
+        self._put("feedback", (rec_id, true_label, is_correct))
+
+    async def flush(self, timeout: float = 2.0) -> bool:
+        """Wait until everything this worker queued is committed."""
+        deadline = time.monotonic() + timeout
+        while self.state.applied_seq[self.worker_index] < self._seq:
+            if time.monotonic() > deadline:
+                print(f"DB writer: worker {self.worker_index} write {self._seq} not committed "
+                      f"after {timeout}s (committed up to {self.state.applied_seq[self.worker_index]})")
+                return False
+            await asyncio.sleep(0.005)
+        return True
+
+
+def _commit(db_path: str, items: list, attempts: int = 5) -> Optional[list]:
+    """Write `items`; returns the feedback items whose row does not exist yet, or None on failure."""
+    predictions = [row for kind, _, _, row in items if kind == "prediction"]
+    feedback = [item for item in items if item[0] == "feedback"]
+    for attempt in range(attempts):
+        try:
+            unmatched = write_batch(db_path, predictions, [item[3] for item in feedback])
+            return [item for item in feedback if item[3] in unmatched]
+        except Exception as e:
+            print(f"DB writer: batch of {len(items)} failed ({e}), attempt {attempt + 1}")
+            time.sleep(0.1 * (attempt + 1))
+    return None
+
+
+def _drop(state: SharedState, items: list, reason: str) -> None:
+    state.incr("dropped_writes", len(items))
+    for kind, worker, seq, row in items:
+        print(f"DB writer: dropped {kind} write {seq} from worker {worker} for id {row[0]} ({reason})")
+
+
+def run_writer(db_path: str, queue, state: SharedState,
+               batch_window: float = 0.02, max_batch: int = 500,
+               feedback_hold: float = 30.0) -> None:
+    """Writer process main loop; returns when it receives None.
+
+    A batch that keeps failing is retried one write at a time, so a single
+    bad row cannot take the rest down with it.  Each worker's queue feeder
+    sends on its own schedule, so feedback can arrive before the insert that
+    another worker queued earlier; it is held and retried for up to
+    `feedback_hold` seconds.  Writes that fail, or whose row never appears,
+    are logged and counted as `dropped_writes`, and never advance applied_seq.
+    """
+    # Ctrl-C reaches the whole process group; the writer must outlive the
+    # workers to commit what they queued, and serve.py stops it with None.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    held = {}  # feedback item -> monotonic time it gives up waiting for its row
+    running = True
+    while running or held:
+        items = list(held)
+        if running:
+            try:
+                # wake up now and then to retry held feedback
+                item = queue.get(timeout=1.0) if held else queue.get()
+            except queue_module.Empty:
+                item = False
+            if item is None:
+                running = False
+            elif item is not False:
+                items.append(item)
+        if not items:
+            continue
+        deadline = time.monotonic() + batch_window
+        while running and len(items) < max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                nxt = queue.get(timeout=remaining)
+            except queue_module.Empty:
+                break
+            if nxt is None:
+                running = False
+                break
+            items.append(nxt)
+
+        waiting = _commit(db_path, items)
+        if waiting is None:
+            waiting, failed = [], []
+            for item in items:
+                result = _commit(db_path, [item], attempts=2)
+                if result is None:
+                    failed.append(item)
+                else:
+                    waiting.extend(result)
+            if failed:
+                _drop(state, failed, "write failed")
+        else:
+            failed = []
+
+        now = time.monotonic()
+        expired = []
+        for item in waiting:
+            give_up = held.get(item, now + feedback_hold)
+            if give_up <= now or not running:
+                expired.append(item)
+            held[item] = give_up
+        for item in expired:
+            del held[item]
+        if expired:
+            _drop(state, expired, "no such prediction")
+        for item in list(held):
+            if item not in waiting:
+                del held[item]
+
+        committed = [item for item in items if item not in waiting and item not in failed]
+
+        for _, worker, seq, _ in committed:
+            if seq > state.applied_seq[worker]:
+                state.applied_seq[worker] = seq
+        if committed:
+            state.bump_data_version()
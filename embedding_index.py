@@ -0,0 +1,255 @@
+"""Append-only, memory-mapped vector index keyed by PredictionLog id.
+
+Each index is a set of shard files in one directory:
+
+    <dir>/<name>.json            {"dim": ..., "dtype": ...}, so retention can
+                                 compact an index without knowing its model
+    <dir>/<name>-w<worker>.idx   fixed-size records: int64 PredictionLog id,
+                                 then the L2-normalised float16 or int8 vector
+
+Every worker process appends only to its own shard (serve.py sets WORKER_ID),
+so writers never coordinate; readers map all shards read-only and score them
+with one matrix-vector product per chunk.  A record is appended with a single
+write, so a worker killed mid-request leaves at most a torn last record, which
+readers ignore and the next append truncates.  int8 rows store the normalised
+vector times 127, which keeps cosine ranking intact at a quarter of the size
+of float32.
+"""
+import os
+import re
+import json
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: serve.py runs a single process there
+    fcntl = None
+
+CHUNK_ROWS = 65536
+SIGNATURE_GRID = 16
+
+_thread_lock = threading.Lock()
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+
+def image_signature(pixels: np.ndarray, grid: int = SIGNATURE_GRID) -> np.ndarray:
+    """Block-averaged `grid` x `grid` thumbnail of the resized RGB pixels.
+
+    It is computed before inference, so a near-duplicate can skip the model
+    entirely.  It takes the pixels rather than the model input: int8 inputs
+    saturate most of the [0, 255] range and would hide the difference between
+    a re-encode and a different frame.  Centering removes brightness offsets.
+    """
+    x = np.asarray(pixels, dtype=np.float32)
+    x = x.reshape(x.shape[-3:])
+    h, w, c = x.shape
+    bh, bw = h // grid, w // grid
+    x = x[:bh * grid, :bw * grid].reshape(grid, bh, grid, bw, c).mean(axis=(1, 3))
+    v = x.reshape(-1)
+    return v - v.mean()
+
+
+class VectorIndex:
+    def __init__(self, directory: str, name: str, dim: int, dtype: str = "float16",
+                 worker_id: Optional[str] = None):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"unsupported vector dtype {dtype}")
+        self.directory = directory
+        self.name = _safe_name(name)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.record = np.dtype([("id", "<i8"), ("vec", self.dtype, (dim,))])
+        self._worker_id = worker_id
+        self._checked = set()
+        self._maps: Dict[str, Tuple[int, int, np.memmap]] = {}
+
+    @classmethod
+    def open_all(cls, directory: str) -> List["VectorIndex"]:
+        """Every index with a metadata file in `directory`."""
+        if not os.path.isdir(directory):
+            return []
+        indexes = []
+        for f in sorted(os.listdir(directory)):
+            if f.endswith(".json"):
+                with open(os.path.join(directory, f), "r", encoding="utf-8") as fh:
+                    meta = json.load(fh)
+                indexes.append(cls(directory, f[:-5], meta["dim"], meta["dtype"]))
+        return indexes
+
+    @property
+    def worker_id(self) -> str:
+        # read per call: indexes are built at import, before serve.py forks
+        if self._worker_id is not None:
+            return self._worker_id
+        return os.environ.get("WORKER_ID", "0")
+
+    def _own_base(self) -> str:
+        return os.path.join(self.directory, f"{self.name}-w{self.worker_id}")
+
+    def _shard_paths(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        prefix = f"{self.name}-w"
+        return sorted(
+            os.path.join(self.directory, f[:-4])
+            for f in os.listdir(self.directory)
+            if f.startswith(prefix) and f.endswith(".idx")
+        )
+
+    @contextmanager
+    def _locked(self, base: str):
+        """Excludes compaction while a record is appended to (or rewritten in) a shard."""
+        with _thread_lock:
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(base + ".lock", os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _encode(self, vector: np.ndarray) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if v.shape[0] != self.dim:
+            raise ValueError(f"expected {self.dim}-d vector, got {v.shape[0]}")
+        norm = np.linalg.norm(v)
+        if norm > 0:
+            v = v / norm
+        if self.dtype == np.int8:
+            return np.clip(np.round(v * 127), -127, 127).astype(np.int8)
+        return v.astype(np.float16)
+
+    def _write_meta(self) -> None:
+        path = os.path.join(self.directory, f"{self.name}.json")
+        if not os.path.exists(path):
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim, "dtype": self.dtype.name}, f)
+            os.replace(tmp, path)
+
+    def add(self, rec_id: int, vector: np.ndarray) -> None:
+        row = np.zeros(1, dtype=self.record)
+        row["id"] = rec_id
+        row["vec"] = self._encode(vector)
+        base = self._own_base()
+        if base not in self._checked:
+            os.makedirs(self.directory, exist_ok=True)
+            self._write_meta()
+        with self._locked(base):
+            fd = os.open(base + ".idx", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                if base not in self._checked:
+                    # a predecessor with this worker id may have died mid-write
+                    size = os.fstat(fd).st_size
+                    if size % self.record.itemsize:
+                        os.ftruncate(fd, size - size % self.record.itemsize)
+                    self._checked.add(base)
+                os.write(fd, row.tobytes())
+            finally:
+                os.close(fd)
+
+    def _shard(self, base: str) -> Optional[np.memmap]:
+        """Read-only records of one shard, remapped only when it has grown or been compacted."""
+        try:
+            st = os.stat(base + ".idx")
+        except FileNotFoundError:
+            return None
+        rows = st.st_size // self.record.itemsize
+        if rows == 0:
+            return None
+        cached = self._maps.get(base)
+        if cached is None or cached[:2] != (st.st_ino, rows):
+            records = np.memmap(base + ".idx", dtype=self.record, mode="r", shape=(rows,))
+            cached = (st.st_ino, rows, records)
+            self._maps[base] = cached
+        return cached[2]
+
+    def __len__(self) -> int:
+        total = 0
+        for base in self._shard_paths():
+            shard = self._shard(base)
+            total += 0 if shard is None else shard.shape[0]
+        return total
+
+    def vector_for(self, rec_id: int) -> Optional[np.ndarray]:
+        for base in self._shard_paths():
+            shard = self._shard(base)
+            if shard is None:
+                continue
+            hits = np.flatnonzero(shard["id"] == rec_id)
+            if hits.size:
+                return self._decode(shard["vec"][hits[-1]])
+        return None
+
+    def _decode(self, rows: np.ndarray) -> np.ndarray:
+        out = np.asarray(rows, dtype=np.float32)
+        return out / 127.0 if self.dtype == np.int8 else out
+
+    def search(self, vector: np.ndarray, k: int = 5, recent: Optional[int] = None,
+               exclude: Optional[int] = None, own_shard: bool = False) -> List[Tuple[int, float]]:
+        """Top-`k` (id, cosine similarity) pairs, best first.
+
+        `recent` limits each shard to its last `recent` rows, which bounds the
+        cost of lookups on the request path; `own_shard` searches only the
+        rows this worker wrote.
+        """
+        query = np.asarray(vector, dtype=np.float32).reshape(-1)
+        query = query / (np.linalg.norm(query) or 1.0)
+        best_ids: List[np.ndarray] = []
+        best_scores: List[np.ndarray] = []
+        bases = [self._own_base()] if own_shard else self._shard_paths()
+        for base in bases:
+            shard = self._shard(base)
+            if shard is None:
+                continue
+            start = max(0, shard.shape[0] - recent) if recent else 0
+            for lo in range(start, shard.shape[0], CHUNK_ROWS):
+                hi = min(lo + CHUNK_ROWS, shard.shape[0])
+                chunk = shard[lo:hi]
+                rows = self._decode(chunk["vec"])
+                scores = rows @ query
+                if self.dtype == np.int8:
+                    # rounding leaves int8 rows slightly off unit length
+                    scores /= np.maximum(np.linalg.norm(rows, axis=1), 1e-6)
+                chunk_ids = np.array(chunk["id"])
+                if exclude is not None:
+                    scores[chunk_ids == exclude] = -np.inf
+                if scores.shape[0] > k:
+                    top = np.argpartition(-scores, k)[:k]
+                    scores, chunk_ids = scores[top], chunk_ids[top]
+                best_scores.append(scores)
+                best_ids.append(chunk_ids)
+        if not best_scores:
+            return []
+        scores = np.concatenate(best_scores)
+        ids = np.concatenate(best_ids)
+        order = np.argsort(-scores)[:k]
+        return [(int(ids[i]), float(scores[i])) for i in order if np.isfinite(scores[i])]
+
+    def compact(self, drop_ids: Iterable[int]) -> int:
+        """Drop rows whose id is in `drop_ids`; returns how many were removed."""
+        drop = np.unique(np.fromiter(drop_ids, dtype=np.int64))
+        removed = 0
+        for base in self._shard_paths():
+            with self._locked(base):
+                size = os.path.getsize(base + ".idx")
+                records = np.fromfile(base + ".idx", dtype=self.record,
+                                      count=size // self.record.itemsize)
+                keep = ~np.isin(records["id"], drop)
+                if keep.all():
+                    continue
+                tmp = f"{base}.idx.{os.getpid()}.tmp"
+                records[keep].tofile(tmp)
+                # readers holding the old mapping keep a consistent snapshot
+                os.replace(tmp, base + ".idx")
+                removed += int((~keep).sum())
+        return removed
@@ -0,0 +1,266 @@
+"""HTTP validator, cache-header and compression helpers shared by the app's routes.
+
+Compression uses brotli when the optional `brotli` package is installed and
+the client accepts it, and gzip otherwise.
+"""
+import os
+import zlib
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import Request
+from fastapi.staticfiles import StaticFiles
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# For content that can never change under its URL (hash-named files)
+IMMUTABLE = "public, max-age=31536000, immutable"
+# For content that may change: browsers keep it but revalidate every time
+REVALIDATE = "no-cache"
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+MIN_COMPRESS_BYTES = 512
+# Bodies with an ETag are compressed once per worker and kept this long
+COMPRESS_CACHE_ENTRIES = 256
+COMPRESS_CACHE_MAX_BYTES = 1024 * 1024
+
+_ENCODING_SUFFIXES = ("-br", "-gzip")
+
+
+def _opaque(etag: str) -> str:
+    """`etag` without weak prefix, quotes, or the suffix added for compressed variants."""
+    bare = etag[2:] if etag.startswith("W/") else etag
+    bare = bare.strip('"')
+    for suffix in _ENCODING_SUFFIXES:
+        if bare.endswith(suffix):
+            return bare[:-len(suffix)]
+    return bare
+
+
+def _with_encoding(etag: str, encoding: str) -> str:
+    if etag.endswith('"'):
+        return f'{etag[:-1]}-{encoding}"'
+    return f"{etag}-{encoding}"
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the request's If-None-Match covers `etag` (weak comparison).
+
+    A validator for a compressed variant of the same content also matches.
+    """
+    return _if_none_match(request.headers, etag)
+
+
+def _if_none_match(headers, etag: str) -> bool:
+    header = headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    bare = _opaque(etag)
+    for candidate in header.split(","):
+        if _opaque(candidate.strip()) == bare:
+            return True
+    return False
+
+
+def file_etag(path: str) -> str:
+    """Weak validator for files whose contents may change in place."""
+    st = os.stat(path)
+    return f'W/"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+_fingerprints = {}
+
+
+def fingerprint(path: str) -> str:
+    """Short content hash of a file, recomputed only when it changes on disk."""
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    value = _fingerprints.get(key)
+    if value is None:
+        with open(path, "rb") as f:
+            value = hashlib.sha256(f.read()).hexdigest()[:12]
+        _fingerprints[key] = value
+    return value
+
+
+class FingerprintedStaticFiles(StaticFiles):
+    """StaticFiles whose `?v=<fingerprint>` URLs may be cached for a year.
+
+    Templates link assets through `static_url()`, so a changed file gets a
+    new URL; requests without (or with a stale) fingerprint revalidate.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        query = scope.get("query_string", b"").decode("latin-1")
+        current = f"v={fingerprint(full_path)}"
+        response.headers["Cache-Control"] = IMMUTABLE if current in query.split("&") else REVALIDATE
+        etag = response.headers.get("etag")
+        if response.status_code == 200 and etag and _if_none_match(Headers(scope=scope), etag):
+            # also covers the -gzip/-br validators the base class does not know
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+# ================= COMPRESSION =================
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Best supported content coding the client accepts: "br", "gzip" or None."""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name] = q
+    wildcard = accepted.get("*", 0.0)
+    if brotli is not None and accepted.get("br", wildcard) > 0:
+        return "br"
+    if accepted.get("gzip", wildcard) > 0:
+        return "gzip"
+    return None
+
+
+def compress(data: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=5 if level is None else level)
+    # wbits 31 = gzip container
+    c = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+
+class _StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._c = brotli.Compressor(quality=5)
+        else:
+            self._c = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._c.process(data) + self._c.flush()
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._c.finish() if self.encoding == "br" else self._c.flush()
+
+
+class CompressionMiddleware:
+    """Compress text responses with brotli or gzip.
+
+    Bodies that carry an ETag are compressed at a higher level once per
+    worker and reused until their ETag changes, so cached pages and API
+    payloads cost no CPU per request.  The cache is keyed by URL as well:
+    StaticFiles ETags hash only mtime and size, so two files can share one.  Compressed variants get the coding
+    appended to their ETag; `etag_matches` accepts either form.
+    """
+
+    def __init__(self, app, minimum_size: int = MIN_COMPRESS_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self._cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+
+    def _compress_cached(self, scope, etag: Optional[str], encoding: str, body: bytes) -> bytes:
+        if not etag or len(body) > COMPRESS_CACHE_MAX_BYTES:
+            return compress(body, encoding)
+        key = (scope["path"], scope.get("query_string", b""), etag, encoding)
+        out = self._cache.get(key)
+        if out is None:
+            out = compress(body, encoding, 9)
+            self._cache[key] = out
+            if len(self._cache) > COMPRESS_CACHE_ENTRIES:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return out
+
+    @staticmethod
+    def _compressible(message) -> bool:
+        if message["status"] != 200:
+            return False
+        headers = Headers(raw=message["headers"])
+        if "content-encoding" in headers or "no-transform" in headers.get("cache-control", ""):
+            return False
+        return headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        mode = None   # None until the first body chunk, then "plain" or "stream"
+        streamer = None
+
+        def encoded_headers(message):
+            headers = MutableHeaders(raw=message["headers"])
+            headers["Content-Encoding"] = encoding
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag:
+                headers["ETag"] = _with_encoding(etag, encoding)
+            return headers
+
+        async def compressing_send(message):
+            nonlocal start, mode, streamer
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or mode == "plain":
+                if start is not None:
+                    await send(start)
+                    start = None
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if mode is None:
+                if not self._compressible(start) or (not more and len(body) < self.minimum_size):
+                    mode = "plain"
+                    if self._compressible(start):
+                        # another client may get this URL compressed
+                        MutableHeaders(raw=start["headers"]).add_vary_header("Accept-Encoding")
+                    await send(start)
+                    start = None
+                    await send(message)
+                    return
+                etag = Headers(raw=start["headers"]).get("etag")
+                headers = encoded_headers(start)
+                if not more:
+                    body = self._compress_cached(scope, etag, encoding, body)
+                    headers["Content-Length"] = str(len(body))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    start = None
+                    return
+                mode = "stream"
+                streamer = _StreamCompressor(encoding)
+                if "content-length" in headers:
+                    del headers["Content-Length"]
+                await send(start)
+                start = None
+
+            out = streamer.chunk(body)
+            if not more:
+                out += streamer.finish()
+            await send({"type": "http.response.body", "body": out, "more_body": more})
+
+        await self.app(scope, receive, compressing_send)
@@ -0,0 +1,121 @@
+"""Content-addressed store for uploaded prediction images.
+
+Originals are written once per distinct content as
+
+    predictions/<aa>/<bb>/<sha256>.<ext>
+
+so repeated uploads of the same bytes share one file and no directory grows
+without bound.  Thumbnails live under `predictions/thumbs/` with the same
+sharding and are generated after the response has been sent.  Because a
+file's name is its hash, its contents never change, which is what lets the
+server hand out strong ETags and year-long cache lifetimes for both.
+"""
+import os
+import re
+import hashlib
+from io import BytesIO
+from typing import Optional, Tuple
+
+from PIL import Image
+
+THUMB_SIZE = 256
+THUMB_DIR = "thumbs"
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def sniff_extension(data: bytes) -> str:
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:2] == b"BM":
+        return "bmp"
+    return "jpg"
+
+
+def path_basename(path: str) -> str:
+    """File name of a stored path; rows may hold Windows as well as POSIX paths."""
+    return re.split(r"[\\/]", path)[-1]
+
+
+def digest_of(path: str) -> Optional[str]:
+    """The content digest encoded in a stored file's name, or None for legacy files."""
+    stem = os.path.splitext(path_basename(path))[0]
+    return stem if _DIGEST_RE.match(stem) else None
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ImageStore:
+    def __init__(self, root: str, thumb_size: int = THUMB_SIZE):
+        self.root = root
+        self.thumb_size = thumb_size
+
+    def _shard(self, digest: str) -> str:
+        return os.path.join(digest[:2], digest[2:4])
+
+    def original_path(self, digest: str, ext: str = "jpg") -> str:
+        return os.path.join(self.root, self._shard(digest), f"{digest}.{ext}")
+
+    def thumb_path(self, digest: str) -> str:
+        return os.path.join(self.root, THUMB_DIR, self._shard(digest), f"{digest}.jpg")
+
+    def find_original(self, digest: str) -> Optional[str]:
+        shard_dir = os.path.join(self.root, self._shard(digest))
+        if os.path.isdir(shard_dir):
+            for name in os.listdir(shard_dir):
+                if name.startswith(digest + "."):
+                    return os.path.join(shard_dir, name)
+        return None
+
+    def put(self, data: bytes) -> Tuple[str, str]:
+        """Store `data` unless identical bytes are already stored; returns (digest, path)."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.original_path(digest, sniff_extension(data))
+        if not os.path.exists(path):
+            _atomic_write(path, data)
+        return digest, path
+
+    def make_thumbnail(self, digest: str) -> Optional[str]:
+        """Create the thumbnail for `digest` if missing; returns its path."""
+        thumb = self.thumb_path(digest)
+        if os.path.exists(thumb):
+            return thumb
+        original = self.find_original(digest)
+        if original is None:
+            return None
+        try:
+            with Image.open(original) as img:
+                # let the JPEG decoder downscale while decoding
+                img.draft("RGB", (self.thumb_size, self.thumb_size))
+                img = img.convert("RGB")
+                img.thumbnail((self.thumb_size, self.thumb_size), Image.BILINEAR)
+                out = BytesIO()
+                img.save(out, "JPEG", quality=80, optimize=True)
+        except OSError:
+            return None
+        _atomic_write(thumb, out.getvalue())
+        return thumb
+
+    def url_for(self, path: str, prefix: str = "/predictions") -> str:
+        digest = digest_of(path)
+        if digest is None:
+            # legacy flat files are served by name
+            return f"{prefix}/{path_basename(path)}"
+        return f"{prefix}/{digest[:2]}/{digest[2:4]}/{path_basename(path)}"
+
+    def thumb_url_for(self, path: str, prefix: str = "/predictions") -> str:
+        """Thumbnail URL for a stored image; legacy flat files have no thumbnail."""
+        digest = digest_of(path)
+        if digest is None:
+            return self.url_for(path, prefix)
+        return f"{prefix}/{THUMB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}.jpg"
@@ -0,0 +1,366 @@
+"""Replay recorded traffic, or generate a synthetic mix, against a running server.
+
+Usage:
+    python loadgen.py replay traffic.jsonl --speed 2 --concurrency 16
+    python loadgen.py synthetic --rate 20 --duration 60 --mix predict=5,frame=3,feedback=1,poll=1
+    python loadgen.py synthetic --rate 0 --requests 500 --concurrency 8
+
+`replay` reads a capture written by traffic_recorder.py (TRAFFIC_LOG=...) and
+keeps its inter-arrival times, scaled by --speed (0 sends as fast as the
+workers allow).  Request bodies come from the capture's payload directory when
+it was recorded with TRAFFIC_PAYLOADS=1, otherwise synthetic ones are sent.
+`synthetic` sends open-loop Poisson arrivals at --rate, or a closed loop with
+--rate 0.  Both report throughput, error rate and latency percentiles overall
+and per route; --report also writes them as JSON.
+
+With NEAR_DUPLICATE_THRESHOLD set, the server answers repeated images without
+running the model; leave it unset to load the interpreter itself.
+"""
+import os
+import re
+import sys
+import json
+import time
+import queue
+import base64
+import random
+import argparse
+import threading
+import http.client
+from io import BytesIO
+from collections import deque
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from traffic_recorder import payload_path
+
+POLL_PATHS = ("/stats", "/history", "/detailed-stats", "/model-performance")
+DEFAULT_MIX = "predict=5,frame=3,feedback=1,poll=1"
+DEFAULT_LABELS = ["Healthy", "Early_blight", "Late_blight"]
+
+
+# ================= PAYLOADS =================
+
+def synthetic_images(count: int = 32, size: int = 1024, seed: int = 0):
+    """Smooth random JPEGs: cheap to make, and not near-duplicates of each other."""
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        small = rng.integers(0, 255, (16, 16, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize((size, size), Image.BICUBIC)
+        out = BytesIO()
+        img.save(out, "JPEG", quality=85)
+        images.append(out.getvalue())
+    return images
+
+
+def load_images(directory: str, limit: int = 200):
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith((".jpg", ".jpeg", ".png")):
+            with open(os.path.join(directory, name), "rb") as f:
+                images.append(f.read())
+            if len(images) >= limit:
+                break
+    if not images:
+        raise SystemExit(f"no .jpg/.png files in {directory}")
+    return images
+
+
+def multipart_body(data: bytes, filename: str = "leaf.jpg"):
+    boundary = f"loadgen{random.getrandbits(64):016x}"
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode("utf-8") + data + f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def json_body(payload: dict):
+    return json.dumps(payload).encode("utf-8"), {"Content-Type": "application/json"}
+
+
+def route_of(path: str) -> str:
+    """Collapse ids so per-route stats group /feedback/12 with /feedback/13."""
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+class Synthesizer:
+    """Builds request bodies; remembers prediction ids so feedback hits real rows."""
+
+    def __init__(self, images):
+        self.images = images
+        self.ids = deque(maxlen=1000)
+
+    def predict(self):
+        body, headers = multipart_body(random.choice(self.images))
+        return "POST", "/predict", body, headers
+
+    def frame(self):
+        frame = "data:image/jpeg;base64," + base64.b64encode(random.choice(self.images)).decode("ascii")
+        body, headers = json_body({"frame": frame})
+        return "POST", "/predict-frame", body, headers
+
+    def feedback(self, path: str = None):
+        if path is None:
+            if not self.ids:
+                return self.predict()
+            path = f"/feedback/{random.choice(self.ids)}"
+        body, headers = json_body({"true_label": random.choice(DEFAULT_LABELS)})
+        return "POST", path, body, headers
+
+    def poll(self):
+        return "GET", random.choice(POLL_PATHS), None, {}
+
+    def observe(self, path: str, status: int, data: bytes):
+        if status == 200 and path.startswith("/predict"):
+            try:
+                self.ids.append(json.loads(data)["id"])
+            except (ValueError, KeyError, TypeError):
+                pass
+
+
+# ================= SCHEDULES =================
+
+def replay_jobs(capture: str, synth: Synthesizer, speed: float, payload_dir: str, prefixes):
+    """(due_seconds, build) pairs from a recorded JSONL capture."""
+    records = []
+    with open(capture, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if prefixes and not rec.get("path", "").startswith(tuple(prefixes)):
+                continue
+            records.append(rec)
+    records.sort(key=lambda r: r["ts"])
+    if not records:
+        raise SystemExit(f"no requests to replay in {capture}")
+    first = records[0]["ts"]
+
+    def build_for(rec):
+        def build():
+            path = rec["path"] + (f"?{rec['query']}" if rec.get("query") else "")
+            ref = rec.get("payload")
+            if ref and os.path.exists(payload_path(payload_dir, ref)):
+                with open(payload_path(payload_dir, ref), "rb") as f:
+                    body = f.read()
+                return rec["method"], path, body, {"Content-Type": rec.get("content_type") or "application/octet-stream"}
+            if rec["path"] == "/predict":
+                return synth.predict()
+            if rec["path"] == "/predict-frame":
+                return synth.frame()
+            if rec["path"].startswith("/feedback/"):
+                return synth.feedback(rec["path"])
+            return rec["method"], path, None, {}
+        return build
+
+    for rec in records:
+        due = (rec["ts"] - first) / speed if speed > 0 else None
+        yield due, build_for(rec)
+
+
+def parse_mix(spec: str):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("predict", "frame", "feedback", "poll"):
+            raise SystemExit(f"unknown request kind in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def synthetic_jobs(synth: Synthesizer, mix: dict, rate: float, duration: float, requests: int):
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    start = time.perf_counter()
+    due = 0.0 if rate > 0 else None
+    sent = 0
+    while True:
+        if requests and sent >= requests:
+            return
+        if rate > 0:
+            due += random.expovariate(rate)
+            if duration and due > duration:
+                return
+        elif duration and time.perf_counter() - start > duration:
+            return
+        kind = random.choices(kinds, weights)[0]
+        yield due, getattr(synth, kind)
+        sent += 1
+
+
+# ================= RUNNER =================
+
+class Connection:
+    """One keep-alive connection per worker thread, reopened after errors."""
+
+    def __init__(self, base_url: str, timeout: float):
+        parts = urlsplit(base_url)
+        self.cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body, headers):
+        if self.conn is None:
+            self.conn = self.cls(self.host, self.port, timeout=self.timeout)
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            return resp.status, resp.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            return 0, b""
+
+
+def run(jobs, base_url: str, concurrency: int, synth: Synthesizer, timeout: float = 30.0):
+    """Send `jobs` from `concurrency` threads; returns (results, elapsed seconds).
+
+    Jobs are (due_seconds, build) with due None for unpaced sends.  Each
+    result is (route, status, latency_ms, lag_ms); lag is how late a request
+    left relative to its schedule, i.e. how far the client fell behind.
+    """
+    pending = queue.Queue(maxsize=concurrency * 4)
+    results = []
+    start = time.perf_counter()
+
+    def worker():
+        conn = Connection(base_url, timeout)
+        while True:
+            job = pending.get()
+            if job is None:
+                return
+            due, build = job
+            if due is not None:
+                delay = due - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            method, path, body, headers = build()
+            sent_at = time.perf_counter()
+            status, data = conn.request(method, path, body, headers)
+            done = time.perf_counter()
+            synth.observe(path, status, data)
+            results.append((route_of(path.split("?")[0]), status,
+                            (done - sent_at) * 1000,
+                            max(0.0, (sent_at - start - due) * 1000) if due is not None else 0.0))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    try:
+        for job in jobs:
+            pending.put(job)
+    except KeyboardInterrupt:
+        print("Interrupted; waiting for in-flight requests")
+    for _ in threads:
+        pending.put(None)
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - start
+
+
+def _summary(rows, elapsed):
+    latencies = np.array([r[2] for r in rows]) if rows else np.zeros(1)
+    errors = sum(1 for r in rows if r[1] == 0 or r[1] >= 400)
+    return {
+        "requests": len(rows),
+        "throughput_rps": round(len(rows) / elapsed, 2) if elapsed > 0 else None,
+        "error_rate": round(errors / len(rows), 4) if rows else None,
+        "latency_ms_p50": round(float(np.percentile(latencies, 50)), 2),
+        "latency_ms_p90": round(float(np.percentile(latencies, 90)), 2),
+        "latency_ms_p99": round(float(np.percentile(latencies, 99)), 2),
+        "latency_ms_max": round(float(latencies.max()), 2),
+    }
+
+
+def summarize(results, elapsed):
+    routes = {}
+    for r in results:
+        routes.setdefault(r[0], []).append(r)
+    statuses = {}
+    for r in results:
+        statuses[str(r[1])] = statuses.get(str(r[1]), 0) + 1
+    lag = np.array([r[3] for r in results]) if results else np.zeros(1)
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "overall": _summary(results, elapsed),
+        "schedule_lag_ms_p99": round(float(np.percentile(lag, 99)), 2),
+        "statuses": statuses,
+        "routes": {name: _summary(rows, elapsed) for name, rows in sorted(routes.items())},
+    }
+
+
+def print_report(report):
+    lines = [
+        f"{'route':<24} {'reqs':>7} {'rps':>8} {'err %':>7} {'p50':>8} {'p90':>8} {'p99':>8}",
+    ]
+    rows = [("ALL", report["overall"])] + list(report["routes"].items())
+    for name, s in rows:
+        err = s["error_rate"] * 100 if s["error_rate"] is not None else 0.0
+        lines.append(
+            f"{name:<24} {s['requests']:>7} {s['throughput_rps'] or 0:>8} {err:>7.2f} "
+            f"{s['latency_ms_p50']:>8} {s['latency_ms_p90']:>8} {s['latency_ms_p99']:>8}"
+        )
+    lines.append(f"elapsed {report['elapsed_s']} s, statuses {report['statuses']}, "
+                 f"schedule lag p99 {report['schedule_lag_ms_p99']} ms")
+    print("\n".join(lines))
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--base-url", default="http://127.0.0.1:8000")
+    common.add_argument("--concurrency", type=int, default=8)
+    common.add_argument("--timeout", type=float, default=30.0)
+    common.add_argument("--images", default=None, help="directory of images to upload (default: synthetic)")
+    common.add_argument("--image-size", type=int, default=1024)
+    common.add_argument("--seed", type=int, default=0)
+    common.add_argument("--report", default=None, help="also write the report as JSON here")
+
+    parser = argparse.ArgumentParser(description="Replay or synthesize load against the server")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rp = sub.add_parser("replay", parents=[common], help="replay a traffic_recorder.py capture")
+    rp.add_argument("capture", nargs="?", default="traffic.jsonl")
+    rp.add_argument("--speed", type=float, default=1.0, help="time scale; 2 = twice as fast, 0 = no pacing")
+    rp.add_argument("--payload-dir", default="traffic_payloads")
+    rp.add_argument("--paths", nargs="*", default=None, help="only replay paths with these prefixes")
+
+    sp = sub.add_parser("synthetic", parents=[common], help="generate a mix of uploads, frames, feedback and polls")
+    sp.add_argument("--mix", default=DEFAULT_MIX)
+    sp.add_argument("--rate", type=float, default=10.0, help="requests/s (Poisson); 0 = closed loop")
+    sp.add_argument("--duration", type=float, default=30.0, help="seconds; 0 = until --requests")
+    sp.add_argument("--requests", type=int, default=0, help="stop after this many; 0 = until --duration")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    images = load_images(args.images) if args.images else synthetic_images(size=args.image_size, seed=args.seed)
+    synth = Synthesizer(images)
+
+    if args.command == "replay":
+        jobs = replay_jobs(args.capture, synth, args.speed, args.payload_dir, args.paths)
+    else:
+        if not args.duration and not args.requests:
+            sp.error("synthetic needs --duration or --requests")
+        jobs = synthetic_jobs(synth, parse_mix(args.mix), args.rate, args.duration, args.requests)
+
+    results, elapsed = run(jobs, args.base_url, max(1, args.concurrency), synth, args.timeout)
+    if not results:
+        print("No requests were sent")
+        sys.exit(1)
+    report = summarize(results, elapsed)
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""Versioned model registry and swappable model handles.
+
+Layout on disk:
+
+    model/registry/
+        ACTIVE                      name of the version to serve
+        v1.1-int8/model.tflite
+        v1.1-int8/labels.txt
+        v1.1-int8/meta.json         optional, free-form metadata
+        ...
+
+When the registry has no versions the legacy `model/tomato_mobilenet_int8.tflite`
+and `labels.txt` are served under the legacy version name, and when no model
+file exists at all a demo handle returning random probabilities is used.
+"""
+import os
+import sys
+import json
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils import load_labels, current_rss_mb, softmax
+
+DEFAULT_LABELS = ["Healthy", "Early_blight", "Late_blight"]
+
+
+def _interpreter_class():
+    """Import the lightest available TFLite interpreter, only when first needed.
+
+    Full TensorFlow is the last resort: importing it costs seconds and
+    hundreds of MB per worker.
+    """
+    try:
+        import tflite_runtime.interpreter as tflite_rt
+        return tflite_rt.Interpreter
+    except ImportError:
+        pass
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    from tensorflow.lite import Interpreter
+    return Interpreter
+
+
+def build_interpreter(path: str, num_threads: Optional[int] = None, share_weights: bool = False):
+    """Interpreter over `path`, which TFLite memory-maps rather than reads.
+
+    The mapped file is shared page cache, but the default XNNPACK delegate
+    repacks the weights into private memory for every interpreter.
+    `share_weights` skips the default delegates so kernels read the weights
+    straight from the shared mapping: far less memory per interpreter and
+    per worker, at some cost in latency (see bench_memory.py).
+    """
+    Interpreter = _interpreter_class()
+    kwargs = {"model_path": path, "num_threads": num_threads}
+    if share_weights:
+        resolver = getattr(sys.modules[Interpreter.__module__], "OpResolverType", None)
+        if resolver is not None:
+            kwargs["experimental_op_resolver_type"] = resolver.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        else:
+            print("This TFLite build cannot disable its default delegates; weights stay private")
+    return Interpreter(**kwargs)
+
+
+class LoadedModel:
+    """An interpreter plus everything needed to run and describe it.
+
+    Handles are immutable once built; swapping models means replacing the
+    handle, so requests that already hold one finish on the old interpreter.
+    """
+
+    def __init__(self, version: str, path: Optional[str], labels: List[str],
+                 meta: Optional[Dict] = None, num_threads: Optional[int] = None,
+                 share_weights: bool = False):
+        self.version = version
+        self.path = path
+        self.labels = labels
+        self.meta = meta or {}
+        self.loaded_at = time.time()
+        # tflite interpreters are not safe to invoke from several threads
+        self.lock = threading.Lock()
+        self.num_threads = num_threads
+        self.share_weights = share_weights
+        # RSS growth while building the interpreter, and across
+        # allocate_tensors() plus a first invoke, which is when the arena's
+        # pages are touched (and default delegates pack their weights).
+        # Estimates: other threads allocate too.
+        self.memory = {"share_weights": share_weights, "load_mb": None, "arena_mb": None}
+        # built on first invoke_batch(); False once the model refused a resize
+        self._batch_interpreter = None
+        self._batch_size = 0
+        self._batch_lock = threading.Lock()
+
+        if path is None:
+            self.interpreter = None
+            self.input_details = {"shape": [1, 224, 224, 3], "dtype": np.float32, "index": 0}
+            self.output_details = {"index": 0, "quantization": (0.0, 0)}
+            self.embedding_details = None
+        else:
+            # import the runtime first so its own footprint is not counted
+            _interpreter_class()
+            before = current_rss_mb()
+            self.interpreter = build_interpreter(path, num_threads, share_weights)
+            built = current_rss_mb()
+            self.interpreter.allocate_tensors()
+            self.input_details = self.interpreter.get_input_details()[0]
+            self.interpreter.set_tensor(self.input_details["index"], np.zeros(
+                self.input_details["shape"], dtype=self.input_details["dtype"]))
+            self.interpreter.invoke()
+            allocated = current_rss_mb()
+            if before is not None and built is not None and allocated is not None:
+                self.memory["load_mb"] = round(built - before, 2)
+                self.memory["arena_mb"] = round(allocated - built, 2)
+            self.memory["file_mb"] = round(os.path.getsize(path) / (1024 * 1024), 2)
+            # Models exported with --embedding carry a second, wider output
+            # (the pooled features); the class scores are the narrowest one.
+            outputs = sorted(self.interpreter.get_output_details(),
+                             key=lambda d: int(np.prod(d["shape"])))
+            self.output_details = outputs[0]
+            self.embedding_details = outputs[-1] if len(outputs) > 1 else None
+
+    @property
+    def demo(self) -> bool:
+        return self.interpreter is None
+
+    def invoke(self, input_data: np.ndarray) -> np.ndarray:
+        """Run one forward pass and return the dequantized output as a flat float32 vector."""
+        with self.lock:
+            self.interpreter.set_tensor(self.input_details["index"], input_data)
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self.output_details["index"])
+        return self._dequantize(output.reshape(-1))
+
+    def _dequantize(self, output: np.ndarray) -> np.ndarray:
+        output = output.astype(np.float32)
+        scale, zero_point = self.output_details.get("quantization", (0.0, 0))
+        if scale:
+            output = (output - zero_point) * scale
+        return output
+
+    def probabilities(self, outputs: np.ndarray) -> np.ndarray:
+        """Class probabilities for invoke()/invoke_batch() outputs, row by row.
+
+        Models trained with train.py end in a softmax, so their outputs are
+        passed through; logits are softmaxed.
+        """
+        outputs = np.asarray(outputs, dtype=np.float32)
+        sums = outputs.sum(axis=-1, keepdims=True)
+        # a quantized softmax sums to 1 only within a few output steps
+        if np.all(outputs >= 0) and np.allclose(sums, 1.0, atol=0.02):
+            return outputs / sums
+        return softmax(outputs)
+
+    @property
+    def embedding_dim(self) -> Optional[int]:
+        if self.embedding_details is None:
+            return None
+        return int(np.prod(self.embedding_details["shape"]))
+
+    def invoke_with_embedding(self, input_data: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Like invoke(), plus the dequantized feature vector when the model has one."""
+        if self.embedding_details is None:
+            return self.invoke(input_data), None
+        with self.lock:
+            self.interpreter.set_tensor(self.input_details["index"], input_data)
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self.output_details["index"])
+            embedding = self.interpreter.get_tensor(self.embedding_details["index"])
+        embedding = embedding.reshape(-1).astype(np.float32)
+        scale, zero_point = self.embedding_details.get("quantization", (0.0, 0))
+        if scale:
+            embedding = (embedding - zero_point) * scale
+        return self._dequantize(output.reshape(-1)), embedding
+
+    def _batch_handle(self, n: int):
+        """Second interpreter over the same file with a batch dimension of `n`.
+
+        Kept apart from the main one so single-image requests never pay for
+        re-allocating tensors between batch sizes.
+        """
+        try:
+            interpreter = build_interpreter(self.path, self.num_threads, self.share_weights)
+            shape = list(self.input_details["shape"])
+            interpreter.resize_tensor_input(self.input_details["index"], [n] + shape[1:])
+            interpreter.allocate_tensors()
+        except Exception as e:
+            print(f"Model {self.version}: batched invoke unavailable ({e}); running inputs one by one")
+            return False
+        output = min(interpreter.get_output_details(), key=lambda d: int(np.prod(d["shape"])))
+        return interpreter, interpreter.get_input_details()[0]["index"], output["index"]
+
+    def invoke_batch(self, batch: np.ndarray, pad_to: Optional[int] = None) -> np.ndarray:
+        """invoke() for a stack of inputs; outputs are shaped (len(batch), outputs).
+
+        Padding to a fixed `pad_to` keeps one batch shape, so the batch
+        interpreter is only allocated once.
+        """
+        n = batch.shape[0]
+        size = max(n, pad_to or 0)
+        with self._batch_lock:
+            if self._batch_interpreter is None or (self._batch_interpreter and self._batch_size != size):
+                self._batch_interpreter = self._batch_handle(size)
+                self._batch_size = size
+            handle = self._batch_interpreter
+            if handle:
+                interpreter, input_index, output_index = handle
+                if size > n:
+                    batch = np.concatenate([batch, np.zeros((size - n,) + batch.shape[1:], batch.dtype)])
+                interpreter.set_tensor(input_index, batch)
+                interpreter.invoke()
+                return self._dequantize(interpreter.get_tensor(output_index).reshape(size, -1)[:n])
+        return np.stack([self.invoke(x[None]) for x in batch])
+
+    def warm_up(self, runs: int = 3) -> None:
+        """Pay the first-invoke cost before the handle receives traffic."""
+        if self.demo:
+            return
+        dummy = np.zeros(self.input_details["shape"], dtype=self.input_details["dtype"])
+        for _ in range(runs):
+            self.invoke(dummy)
+
+
+class ModelRegistry:
+    def __init__(self, root: str, legacy_model_path: str, legacy_labels_path: str,
+                 legacy_version: str, num_threads: Optional[int] = None,
+                 share_weights: bool = False):
+        self.root = root
+        # interpreter threads per model; serve.py divides the cores between workers
+        self.num_threads = num_threads
+        self.share_weights = share_weights
+        self.legacy_model_path = legacy_model_path
+        self.legacy_labels_path = legacy_labels_path
+        self.legacy_version = legacy_version
+
+    @property
+    def active_file(self) -> str:
+        return os.path.join(self.root, "ACTIVE")
+
+    def versions(self) -> List[Dict]:
+        """All registered versions, oldest first."""
+        out = []
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                model_file = os.path.join(self.root, name, "model.tflite")
+                if os.path.isfile(model_file):
+                    out.append({
+                        "version": name,
+                        "size_mb": round(os.path.getsize(model_file) / (1024 * 1024), 2),
+                        "created_at": os.path.getmtime(model_file),
+                        "meta": self._meta(name),
+                    })
+        out.sort(key=lambda v: v["created_at"])
+        return out
+
+    def active_version(self) -> str:
+        """Version named in ACTIVE, else the newest registered one, else the legacy model."""
+        if os.path.exists(self.active_file):
+            with open(self.active_file, "r", encoding="utf-8") as f:
+                name = f.read().strip()
+            if name:
+                return name
+        versions = self.versions()
+        return versions[-1]["version"] if versions else self.legacy_version
+
+    def set_active(self, version: str) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.active_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(version + "\n")
+        os.replace(tmp, self.active_file)
+
+    def publish(self, version: str, model_file: str, labels_path: Optional[str] = None,
+                meta: Optional[Dict] = None) -> str:
+        """Copy a model (and its labels) in as a new version; returns its directory.
+
+        The version directory appears in one rename, so the registry watcher
+        never sees it half-written.
+        """
+        target = os.path.join(self.root, version)
+        if os.path.exists(target):
+            raise ValueError(f"model version {version} already exists")
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, f".{version}.{os.getpid()}.tmp")
+        os.makedirs(tmp)
+        shutil.copyfile(model_file, os.path.join(tmp, "model.tflite"))
+        if labels_path and os.path.exists(labels_path):
+            shutil.copyfile(labels_path, os.path.join(tmp, "labels.txt"))
+        if meta:
+            with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, indent=2)
+        os.replace(tmp, target)
+        return target
+
+    def _meta(self, version: str) -> Dict:
+        path = os.path.join(self.root, version, "meta.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load(self, version: str) -> LoadedModel:
+        """Build a handle for `version`. Raises KeyError for unknown versions."""
+        if version == self.legacy_version:
+            labels = load_labels(self.legacy_labels_path) or DEFAULT_LABELS
+            path = self.legacy_model_path if os.path.exists(self.legacy_model_path) else None
+            return LoadedModel(version, path, labels, num_threads=self.num_threads,
+                               share_weights=self.share_weights)
+
+        model_dir = os.path.join(self.root, version)
+        model_file = os.path.join(model_dir, "model.tflite")
+        if not os.path.isfile(model_file):
+            raise KeyError(version)
+        labels = (load_labels(os.path.join(model_dir, "labels.txt"))
+                  or load_labels(self.legacy_labels_path)
+                  or DEFAULT_LABELS)
+        return LoadedModel(version, model_file, labels, self._meta(version),
+                           num_threads=self.num_threads, share_weights=self.share_weights)
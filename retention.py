@@ -0,0 +1,441 @@
+"""Retention, archival and compaction for PredictionLog and stored images.
+
+One pass (`run_retention`) does, oldest rows first and in small batches so
+live inserts are never blocked for long:
+
+1. Expire images: rows past `image_days` (`feedback_image_days` for rows with
+   feedback) lose their image.  With `archive_images` the file is first copied
+   into `archive/images-YYYY-MM.zip` and the row id is recorded next to it in
+   `archive/images-YYYY-MM.csv.gz`; the file is deleted once no other row that
+   still keeps its image points at it.
+2. Archive rows: rows past `raw_days` (`feedback_raw_days`) are appended to
+   `archive/predictions-YYYY-MM.csv.gz`, any image they still have is copied
+   into `archive/images-YYYY-MM.zip`, their counts are rolled up into
+   PredictionDaily (which the stats queries in database.py include) and the
+   raw rows are deleted.
+3. Reclaim space with `PRAGMA incremental_vacuum`.
+4. Compact the vector indexes under `embeddings_dir` (embedding_index.py),
+   dropping the ids step 2 deleted from PredictionLog.
+
+Policies come from `retention.json` (any subset of DEFAULT_POLICY); a value of
+null disables that step.  Archives are ordinary gzip/zip files and can be
+read back with `python retention.py query`.
+
+Usage:
+    python retention.py run
+    python retention.py query --since 2026-01-01 --label Tomato___Early_blight
+    python retention.py vacuum --full     # one-off, converts older databases
+"""
+import os
+import csv
+import sys
+import gzip
+import json
+import time
+import sqlite3
+import zipfile
+import argparse
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional
+
+from image_store import ImageStore, digest_of, path_basename
+from embedding_index import VectorIndex
+
+DEFAULT_POLICY = {
+    "raw_days": 180,
+    "feedback_raw_days": 730,
+    "image_days": 90,
+    "feedback_image_days": 365,
+    "archive_images": True,
+    "batch_size": 500,
+    "pause_seconds": 0.05,
+    "vacuum_pages": 2000,
+}
+
+ARCHIVE_COLUMNS = ["id", "image_path", "predicted_label", "confidence", "true_label", "is_correct",
+                   "inference_time", "created_at", "model_version", "archived_image"]
+IMAGE_ARCHIVE_COLUMNS = ["id", "image_path", "created_at", "archived_image"]
+
+
+def load_policy(path: Optional[str]) -> Dict:
+    policy = dict(DEFAULT_POLICY)
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            policy.update(json.load(f))
+    return policy
+
+
+def _cutoff(days: float, now: datetime) -> str:
+    return (now - timedelta(days=days)).isoformat()
+
+
+def _feedback_clause(with_feedback: bool) -> str:
+    return "is_correct IS NOT NULL" if with_feedback else "is_correct IS NULL"
+
+
+def _resolve_image(path: str, predictions_dir: str) -> Optional[str]:
+    """Local file for a stored path; legacy rows may hold another host's absolute path."""
+    if os.path.exists(path):
+        return path
+    digest = digest_of(path)
+    if digest:
+        candidate = os.path.join(predictions_dir, digest[:2], digest[2:4], path_basename(path))
+    else:
+        candidate = os.path.join(predictions_dir, path_basename(path))
+    return candidate if os.path.exists(candidate) else None
+
+
+def _delete_unreferenced(conn: sqlite3.Connection, paths: set, store: ImageStore) -> int:
+    deleted = 0
+    for path in paths:
+        still_used = conn.execute(
+            'SELECT 1 FROM PredictionLog WHERE image_path = ? LIMIT 1', (path,)
+        ).fetchone()
+        if still_used:
+            continue
+        local = _resolve_image(path, store.root)
+        if local:
+            os.remove(local)
+            deleted += 1
+        digest = digest_of(path)
+        if digest and os.path.exists(store.thumb_path(digest)):
+            os.remove(store.thumb_path(digest))
+    return deleted
+
+
+def _zip_images(archive_dir: str, month: str, paths: List[Optional[str]],
+                store: ImageStore) -> List[Optional[str]]:
+    """Copy each stored image into that month's zip; returns "zip:member" references."""
+    local_files = [_resolve_image(p, store.root) if p else None for p in paths]
+    if not any(local_files):
+        return [None] * len(paths)
+    zip_name = f"images-{month}.zip"
+    refs: List[Optional[str]] = []
+    # JPEG/PNG data does not deflate; store members as-is
+    with zipfile.ZipFile(os.path.join(archive_dir, zip_name), "a", compression=zipfile.ZIP_STORED) as zf:
+        present = set(zf.namelist())
+        for path, local in zip(paths, local_files):
+            if local is None:
+                refs.append(None)
+                continue
+            name = path_basename(path)
+            if name not in present:
+                zf.write(local, name)
+                present.add(name)
+            refs.append(f"{zip_name}:{name}")
+    return refs
+
+
+def _archive_expiring(archive_dir: str, batch: List[tuple], store: ImageStore) -> None:
+    by_month: Dict[str, List[tuple]] = {}
+    for rec_id, path, created_at in batch:
+        by_month.setdefault(str(created_at)[:7], []).append((rec_id, path, created_at))
+    for month, month_rows in by_month.items():
+        refs = _zip_images(archive_dir, month, [r[1] for r in month_rows], store)
+        csv_path = os.path.join(archive_dir, f"images-{month}.csv.gz")
+        new_file = not os.path.exists(csv_path)
+        with gzip.open(csv_path, "at", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(IMAGE_ARCHIVE_COLUMNS)
+            writer.writerows(list(row) + [ref] for row, ref in zip(month_rows, refs) if ref)
+
+
+def expire_images(db_path: str, store: ImageStore, policy: Dict, now: datetime,
+                  archive_dir: Optional[str] = None) -> Dict:
+    """Drop images past their retention; with `archive_images` they are zipped first.
+
+    Images usually expire long before their rows are archived, so this is
+    where archive_rows would otherwise find nothing left to copy.
+    """
+    archive = bool(archive_dir and policy["archive_images"])
+    if archive:
+        os.makedirs(archive_dir, exist_ok=True)
+    rows = files = 0
+    conn = sqlite3.connect(db_path)
+    try:
+        for with_feedback in (False, True):
+            days = policy["feedback_image_days" if with_feedback else "image_days"]
+            if days is None:
+                continue
+            cutoff = _cutoff(days, now)
+            while True:
+                batch = conn.execute(
+                    'SELECT id, image_path, created_at FROM PredictionLog WHERE image_path IS NOT NULL '
+                    'AND created_at < ? AND ' + _feedback_clause(with_feedback)
+                    + ' ORDER BY created_at LIMIT ?',
+                    (cutoff, policy["batch_size"]),
+                ).fetchall()
+                if not batch:
+                    break
+                if archive:
+                    # as in archive_rows, a crash before the update only duplicates archive lines
+                    _archive_expiring(archive_dir, batch, store)
+                conn.executemany('UPDATE PredictionLog SET image_path = NULL WHERE id = ?',
+                                 [(rec_id,) for rec_id, _, _ in batch])
+                conn.commit()
+                rows += len(batch)
+                files += _delete_unreferenced(conn, {p for _, p, _ in batch}, store)
+                time.sleep(policy["pause_seconds"])
+    finally:
+        conn.close()
+    return {"rows": rows, "files_deleted": files}
+
+
+def _append_archive(archive_dir: str, rows: List[tuple], store: ImageStore,
+                    archive_images: bool) -> None:
+    by_month: Dict[str, List[list]] = {}
+    for row in rows:
+        by_month.setdefault(str(row[7])[:7], []).append(list(row))
+
+    for month, month_rows in by_month.items():
+        paths = [row[1] for row in month_rows] if archive_images else [None] * len(month_rows)
+        for row, ref in zip(month_rows, _zip_images(archive_dir, month, paths, store)):
+            row.append(ref)
+
+        csv_path = os.path.join(archive_dir, f"predictions-{month}.csv.gz")
+        new_file = not os.path.exists(csv_path)
+        # every append is its own gzip member; readers see one continuous stream
+        with gzip.open(csv_path, "at", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(ARCHIVE_COLUMNS)
+            writer.writerows(month_rows)
+
+
+_ROLLUP_SQL = '''
+    INSERT INTO PredictionDaily (day, model_version, predicted_label, total, sum_confidence,
+        sum_inference_time, timed, min_inference_time, max_inference_time, conf_high, conf_medium,
+        conf_low, with_feedback, correct, feedback_sum_confidence, first_seen, last_seen)
+    SELECT substr(created_at, 1, 10), COALESCE(model_version, ''), COALESCE(predicted_label, ''),
+           COUNT(*),
+           SUM(confidence),
+           SUM(COALESCE(inference_time, 0)),
+           COUNT(inference_time),
+           MIN(inference_time),
+           MAX(inference_time),
+           SUM(CASE WHEN confidence >= 0.9 THEN 1 ELSE 0 END),
+           SUM(CASE WHEN confidence >= 0.7 AND confidence < 0.9 THEN 1 ELSE 0 END),
+           SUM(CASE WHEN confidence < 0.7 THEN 1 ELSE 0 END),
+           SUM(CASE WHEN is_correct IS NOT NULL THEN 1 ELSE 0 END),
+           SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END),
+           SUM(CASE WHEN is_correct IS NOT NULL THEN confidence ELSE 0 END),
+           MIN(created_at),
+           MAX(created_at)
+    FROM PredictionLog
+    WHERE id IN (SELECT id FROM temp.retention_batch)
+    GROUP BY 1, 2, 3
+    ON CONFLICT(day, model_version, predicted_label) DO UPDATE SET
+        total = total + excluded.total,
+        sum_confidence = sum_confidence + excluded.sum_confidence,
+        sum_inference_time = sum_inference_time + excluded.sum_inference_time,
+        timed = COALESCE(timed, total) + excluded.timed,
+        min_inference_time = MIN(COALESCE(min_inference_time, excluded.min_inference_time),
+                                 COALESCE(excluded.min_inference_time, min_inference_time)),
+        max_inference_time = MAX(COALESCE(max_inference_time, excluded.max_inference_time),
+                                 COALESCE(excluded.max_inference_time, max_inference_time)),
+        conf_high = conf_high + excluded.conf_high,
+        conf_medium = conf_medium + excluded.conf_medium,
+        conf_low = conf_low + excluded.conf_low,
+        with_feedback = with_feedback + excluded.with_feedback,
+        correct = correct + excluded.correct,
+        feedback_sum_confidence = feedback_sum_confidence + excluded.feedback_sum_confidence,
+        first_seen = MIN(first_seen, excluded.first_seen),
+        last_seen = MAX(last_seen, excluded.last_seen)
+'''
+
+
+def archive_rows(db_path: str, store: ImageStore, archive_dir: str, policy: Dict,
+                 now: datetime) -> Dict:
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = files = 0
+    deleted: List[int] = []
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS retention_batch(id INTEGER PRIMARY KEY)')
+    try:
+        for with_feedback in (False, True):
+            days = policy["feedback_raw_days" if with_feedback else "raw_days"]
+            if days is None:
+                continue
+            cutoff = _cutoff(days, now)
+            while True:
+                rows = conn.execute(
+                    'SELECT id, image_path, predicted_label, confidence, true_label, is_correct, '
+                    'inference_time, created_at, model_version FROM PredictionLog '
+                    'WHERE created_at < ? AND ' + _feedback_clause(with_feedback)
+                    + ' ORDER BY created_at LIMIT ?',
+                    (cutoff, policy["batch_size"]),
+                ).fetchall()
+                if not rows:
+                    break
+
+                # Archive files are written outside the write transaction; a
+                # crash before the commit below can only duplicate archive lines.
+                _append_archive(archive_dir, rows, store, policy["archive_images"])
+
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('DELETE FROM temp.retention_batch')
+                conn.executemany('INSERT INTO temp.retention_batch(id) VALUES (?)',
+                                 [(r[0],) for r in rows])
+                conn.execute(_ROLLUP_SQL)
+                conn.execute('DELETE FROM PredictionLog WHERE id IN (SELECT id FROM temp.retention_batch)')
+                conn.commit()
+
+                archived += len(rows)
+                deleted.extend(r[0] for r in rows)
+                files += _delete_unreferenced(conn, {r[1] for r in rows if r[1]}, store)
+                time.sleep(policy["pause_seconds"])
+    finally:
+        conn.close()
+    return {"rows": archived, "files_deleted": files, "ids": deleted}
+
+
+def incremental_vacuum(db_path: str, pages: int) -> Dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if mode != 2:
+            return {"skipped": "auto_vacuum is not INCREMENTAL; run `python retention.py vacuum --full` once"}
+        before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+        after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    finally:
+        conn.close()
+    return {"pages_freed": before - after, "pages_free": after}
+
+
+def full_vacuum(db_path: str) -> None:
+    """Rebuild the file with incremental auto-vacuum enabled. Blocks writers; run offline."""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+
+def compact_indexes(embeddings_dir: str, deleted_ids: List[int]) -> Dict:
+    """Drop exactly the ids archive_rows deleted.
+
+    Diffing against a snapshot of PredictionLog instead would also drop
+    vectors whose rows are still queued in db_writer.
+    """
+    if not deleted_ids:
+        return {"rows": 0}
+    return {"rows": sum(index.compact(deleted_ids) for index in VectorIndex.open_all(embeddings_dir))}
+
+
+def run_retention(db_path: str, predictions_dir: str, archive_dir: str, policy: Dict,
+                  on_change: Optional[Callable[[], None]] = None,
+                  now: Optional[datetime] = None, embeddings_dir: Optional[str] = None) -> Dict:
+    now = now or datetime.utcnow()
+    store = ImageStore(predictions_dir)
+    result = {
+        "images": expire_images(db_path, store, policy, now, archive_dir),
+        "archive": archive_rows(db_path, store, archive_dir, policy, now),
+    }
+    if policy.get("vacuum_pages"):
+        result["vacuum"] = incremental_vacuum(db_path, policy["vacuum_pages"])
+    deleted_ids = result["archive"].pop("ids")
+    if embeddings_dir:
+        result["indexes"] = compact_indexes(embeddings_dir, deleted_ids)
+    if on_change and (result["images"]["rows"] or result["archive"]["rows"]):
+        on_change()
+    return result
+
+
+def run_retention_loop(db_path: str, predictions_dir: str, archive_dir: str,
+                       policy_path: Optional[str], interval: float,
+                       on_change: Optional[Callable[[], None]] = None,
+                       embeddings_dir: Optional[str] = None) -> None:
+    """Process entry point for serve.py; re-reads the policy file every pass."""
+    while True:
+        time.sleep(interval)
+        try:
+            result = run_retention(db_path, predictions_dir, archive_dir,
+                                   load_policy(policy_path), on_change, embeddings_dir=embeddings_dir)
+            print(f"Retention: {json.dumps(result)}")
+        except Exception as e:
+            print(f"Retention pass failed: {e}")
+
+
+def iter_archive(archive_dir: str, since: Optional[str] = None,
+                 until: Optional[str] = None) -> Iterator[Dict]:
+    """Rows from the archive files, optionally limited to [since, until) by created_at.
+
+    Rows whose image expired before the row itself was archived get their
+    image back from that month's images-YYYY-MM.csv.gz.
+    """
+    if not os.path.isdir(archive_dir):
+        return
+    for name in sorted(os.listdir(archive_dir)):
+        if not (name.startswith("predictions-") and name.endswith(".csv.gz")):
+            continue
+        month = name[len("predictions-"):-len(".csv.gz")]
+        if since and month < since[:7]:
+            continue
+        if until and month > until[:7]:
+            continue
+        expired = {}
+        expired_path = os.path.join(archive_dir, f"images-{month}.csv.gz")
+        if os.path.exists(expired_path):
+            with gzip.open(expired_path, "rt", newline="", encoding="utf-8") as f:
+                expired = {r["id"]: r for r in csv.DictReader(f)}
+        with gzip.open(os.path.join(archive_dir, name), "rt", newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                if since and row["created_at"] < since:
+                    continue
+                if until and row["created_at"] >= until:
+                    continue
+                if not row["archived_image"] and row["id"] in expired:
+                    row["image_path"] = expired[row["id"]]["image_path"]
+                    row["archived_image"] = expired[row["id"]]["archived_image"]
+                yield row
+
+
+def main():
+    app_root = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Prediction log retention and archives")
+    parser.add_argument("--db", default=os.path.join(app_root, "predictions.db"))
+    parser.add_argument("--predictions-dir", default=os.path.join(app_root, "predictions"))
+    parser.add_argument("--archive-dir", default=os.path.join(app_root, "archive"))
+    parser.add_argument("--embeddings-dir", default=os.path.join(app_root, "embeddings"))
+    parser.add_argument("--policy", default=os.path.join(app_root, "retention.json"))
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("run", help="apply the retention policy once")
+
+    query = sub.add_parser("query", help="print archived rows as CSV")
+    query.add_argument("--since")
+    query.add_argument("--until")
+    query.add_argument("--label")
+    query.add_argument("--model-version")
+
+    vacuum = sub.add_parser("vacuum", help="reclaim free pages")
+    vacuum.add_argument("--full", action="store_true", help="rebuild and enable incremental vacuum")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        from database import init_db
+        init_db(args.db)
+        result = run_retention(args.db, args.predictions_dir, args.archive_dir, load_policy(args.policy),
+                               embeddings_dir=args.embeddings_dir)
+        print(json.dumps(result, indent=2))
+    elif args.command == "query":
+        writer = csv.DictWriter(sys.stdout, fieldnames=ARCHIVE_COLUMNS)
+        writer.writeheader()
+        for row in iter_archive(args.archive_dir, args.since, args.until):
+            if args.label and row["predicted_label"] != args.label:
+                continue
+            if args.model_version and row["model_version"] != args.model_version:
+                continue
+            writer.writerow(row)
+    elif args.command == "vacuum":
+        if args.full:
+            full_vacuum(args.db)
+        print(json.dumps(incremental_vacuum(args.db, DEFAULT_POLICY["vacuum_pages"])))
+
+
+if __name__ == "__main__":
+    main()
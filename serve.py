@@ -0,0 +1,172 @@
+"""Run the app with several worker processes.
+
+    python serve.py --workers 4 --port 8000
+
+The parent process binds the listening socket, creates the shared state
+(shared_state.py) and starts one DB writer process, then forks the workers.
+Each worker runs its own uvicorn server on the inherited socket and loads its
+own interpreter; PredictionLog writes go through the writer (db_writer.py), so
+workers never contend on SQLite write locks.  Crashed workers and a crashed
+writer are restarted.  With RETENTION_INTERVAL set, one more process runs
+retention.py passes.
+
+Forking is required, so on Windows this falls back to a single process, as
+does `--workers 1`.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+import multiprocessing
+
+
+def _run_worker(sock, index, host, port, log_level):
+    import uvicorn
+    import app as app_module
+    from utils import StartupProfile
+
+    # The parent imported app before forking, possibly hours ago for a
+    # restarted worker; /ready should time this worker's own startup.
+    app_module.startup_profile = StartupProfile()
+
+    # Each worker owns a slot in applied_seq for its queued writes; a
+    # restarted worker continues from what its predecessor had committed.
+    app_module.db_writer.worker_index = index
+    app_module.db_writer._seq = app_module.shared_state.applied_seq[index]
+    os.environ["WORKER_ID"] = str(index)
+
+    config = uvicorn.Config(app_module.app, host=host, port=port, log_level=log_level)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+def _run_retention(*args):
+    from retention import run_retention_loop
+
+    # a terminal Ctrl-C must not interrupt a pass halfway through archiving
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_retention_loop(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the app with multiple worker processes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--share-weights", action="store_true",
+                        help="read model weights from the shared file mapping in every worker "
+                             "(same as TFLITE_SHARE_WEIGHTS=1; see model_registry.build_interpreter)")
+    args = parser.parse_args()
+
+    if args.share_weights:
+        os.environ["TFLITE_SHARE_WEIGHTS"] = "1"
+
+    from shared_state import MAX_WORKERS
+    workers = max(1, min(args.workers, MAX_WORKERS))
+
+    if workers == 1 or not hasattr(os, "fork"):
+        import uvicorn
+        uvicorn.run("app:app", host=args.host, port=args.port, log_level=args.log_level)
+        return
+
+    # Split the cores between workers instead of letting every interpreter
+    # start one thread per core.
+    os.environ.setdefault("TFLITE_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+
+    ctx = multiprocessing.get_context("fork")
+
+    import app as app_module
+    from database import init_db, get_max_id
+    from db_writer import QueueWriter, run_writer
+    from shared_state import SharedState
+
+    init_db(app_module.DB_PATH)
+    state = SharedState(ctx)
+    state.next_id.value = get_max_id(app_module.DB_PATH) + 1
+    queue = ctx.Queue()
+    app_module.configure_workers(state, QueueWriter(queue, state), workers)
+
+    def start_writer(restart=False):
+        if restart:
+            # A writer killed inside queue.get() dies holding the queue's read
+            # lock.  It is the queue's only reader, so free the lock for the
+            # replacement; acquiring first keeps this a no-op when it was free.
+            queue._rlock.acquire(block=False)
+            queue._rlock.release()
+        p = ctx.Process(target=run_writer, args=(app_module.DB_PATH, queue, state),
+                        name="db-writer")
+        p.start()
+        return p
+
+    writer = start_writer()
+
+    retention = None
+    if app_module.RETENTION_INTERVAL > 0:
+        retention = ctx.Process(
+            target=_run_retention,
+            args=(app_module.DB_PATH, app_module.PREDICTIONS_DIR, app_module.ARCHIVE_DIR,
+                  app_module.RETENTION_POLICY_PATH, app_module.RETENTION_INTERVAL,
+                  state.bump_data_version, app_module.EMBEDDINGS_DIR),
+            name="retention", daemon=True,
+        )
+        retention.start()
+
+    sock = socket.socket(socket.AF_INET6 if ":" in args.host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    def spawn(index):
+        p = ctx.Process(target=_run_worker,
+                        args=(sock, index, args.host, args.port, args.log_level),
+                        name=f"worker-{index}")
+        p.start()
+        return p
+
+    procs = {i: spawn(i) for i in range(workers)}
+    print(f"Serving on {args.host}:{args.port} with {workers} workers (pid {os.getpid()})")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while not stopping:
+        time.sleep(0.5)
+        for i, p in list(procs.items()):
+            if not p.is_alive() and not stopping:
+                print(f"Worker {i} exited with code {p.exitcode}; restarting")
+                procs[i] = spawn(i)
+        if not writer.is_alive():
+            # writes it had taken off the queue but not committed are lost
+            print(f"DB writer exited with code {writer.exitcode}; restarting")
+            writer = start_writer(restart=True)
+
+    for p in procs.values():
+        if p.is_alive():
+            p.terminate()
+    for p in procs.values():
+        p.join(timeout=10)
+
+    if retention is not None:
+        retention.terminate()
+
+    # Let the writer drain everything the workers queued
+    if not writer.is_alive():
+        writer = start_writer(restart=True)
+    queue.put(None)
+    writer.join(timeout=30)
+    sock.close()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
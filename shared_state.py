@@ -0,0 +1,148 @@
+"""State shared by every worker process of one server.
+
+Everything here lives in `multiprocessing` shared memory, so objects created
+in the parent before workers are forked (see serve.py) are visible to all of
+them.  A single-process server uses the same classes; they just never cross a
+process boundary there.
+"""
+import multiprocessing
+from typing import Callable, Optional
+
+import numpy as np
+
+COUNTERS = (
+    "predictions",
+    "feedback",
+    "cache_hits",
+    "cache_misses",
+    "errors",
+    "near_duplicates",
+    "dropped_writes",
+)
+
+CACHE_SLOTS = ("stats", "detailed_stats", "model_performance", "history")
+CACHE_SLOT_BYTES = 512 * 1024
+
+MAX_WORKERS = 64
+
+SMOOTHER_WINDOW = 5
+SMOOTHER_MAX_CLASSES = 64
+
+
+class SharedState:
+    """Counters, id allocation, data version and JSON caches in shared memory."""
+
+    def __init__(self, ctx=None):
+        ctx = ctx or multiprocessing.get_context()
+        # Bumped after every committed write; readers key caches on it.
+        self.data_version = ctx.Value("q", 0)
+        # Next PredictionLog id, so workers can answer before the row is written.
+        self.next_id = ctx.Value("q", 0)
+        self._counters = ctx.Array("q", len(COUNTERS))
+        # applied_seq[w] = highest write sequence from worker w the DB writer committed
+        self.applied_seq = ctx.RawArray("q", MAX_WORKERS)
+
+        self._cache_lock = ctx.Lock()
+        self._cache_versions = ctx.RawArray("q", len(CACHE_SLOTS))
+        self._cache_lengths = ctx.RawArray("q", len(CACHE_SLOTS))
+        self._cache_data = [ctx.RawArray("c", CACHE_SLOT_BYTES) for _ in CACHE_SLOTS]
+        for i in range(len(CACHE_SLOTS)):
+            self._cache_versions[i] = -1
+
+        self.smoother_lock = ctx.Lock()
+        self.smoother_buf = ctx.RawArray("f", SMOOTHER_WINDOW * SMOOTHER_MAX_CLASSES)
+        self.smoother_meta = ctx.RawArray("q", 3)  # filled, position, num_classes
+
+    # ---- counters ----
+
+    def incr(self, name: str, n: int = 1) -> None:
+        i = COUNTERS.index(name)
+        with self._counters.get_lock():
+            self._counters[i] += n
+
+    def counters(self) -> dict:
+        with self._counters.get_lock():
+            return dict(zip(COUNTERS, self._counters[:]))
+
+    # ---- ids and versions ----
+
+    def allocate_id(self) -> int:
+        with self.next_id.get_lock():
+            rec_id = self.next_id.value
+            self.next_id.value += 1
+        return rec_id
+
+    def bump_data_version(self) -> int:
+        with self.data_version.get_lock():
+            self.data_version.value += 1
+            return self.data_version.value
+
+    # ---- JSON caches ----
+
+    def cache_get(self, slot: str, version: int) -> Optional[bytes]:
+        i = CACHE_SLOTS.index(slot)
+        with self._cache_lock:
+            if self._cache_versions[i] != version:
+                return None
+            return self._cache_data[i].raw[:self._cache_lengths[i]]
+
+    def cache_put(self, slot: str, version: int, payload: bytes) -> None:
+        if len(payload) > CACHE_SLOT_BYTES:
+            return
+        i = CACHE_SLOTS.index(slot)
+        with self._cache_lock:
+            self._cache_data[i][:len(payload)] = payload
+            self._cache_lengths[i] = len(payload)
+            self._cache_versions[i] = version
+
+    def cached(self, slot: str, compute: Callable[[], bytes]) -> bytes:
+        """Return the cached payload for the current data version, computing it on a miss."""
+        version = self.data_version.value
+        payload = self.cache_get(slot, version)
+        if payload is not None:
+            self.incr("cache_hits")
+            return payload
+        self.incr("cache_misses")
+        payload = compute()
+        self.cache_put(slot, version, payload)
+        return payload
+
+
+class SharedPredictionSmoother:
+    """`utils.PredictionSmoother` with its window kept in shared memory.
+
+    Every worker contributes to and reads from one window, so a camera stream
+    whose frames land on different workers is smoothed as if one process
+    served it.
+    """
+
+    def __init__(self, state: SharedState, window_size: int = SMOOTHER_WINDOW):
+        self.state = state
+        self.window_size = min(window_size, SMOOTHER_WINDOW)
+
+    def _window(self) -> np.ndarray:
+        return np.frombuffer(self.state.smoother_buf, dtype=np.float32).reshape(
+            SMOOTHER_WINDOW, SMOOTHER_MAX_CLASSES
+        )
+
+    def update(self, probs: np.ndarray, labels: list) -> tuple:
+        probs = np.asarray(probs).astype(np.float32).reshape(-1)[:SMOOTHER_MAX_CLASSES]
+        n = probs.shape[0]
+        meta = self.state.smoother_meta
+        with self.state.smoother_lock:
+            window = self._window()
+            if meta[2] != n:
+                meta[0] = meta[1] = 0
+                meta[2] = n
+            window[meta[1], :n] = probs
+            meta[1] = (meta[1] + 1) % self.window_size
+            meta[0] = min(meta[0] + 1, self.window_size)
+            avg = window[:meta[0], :n].mean(axis=0)
+        idx = int(np.argmax(avg))
+        label = labels[idx] if idx < len(labels) else str(idx)
+        return label, float(avg[idx])
+
+    def reset(self) -> None:
+        with self.state.smoother_lock:
+            self.state.smoother_meta[0] = 0
+            self.state.smoother_meta[1] = 0
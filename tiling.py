@@ -0,0 +1,143 @@
+"""Tiled multi-crop inference for high-resolution photos.
+
+Squashing a 12 MP photo of a whole plant into one 224x224 input loses small
+lesions.  Tiled mode instead classifies
+
+    - a global view of the whole image (what untiled mode sees), and
+    - overlapping square tiles at one or more scales, where a scale is the
+      tile side as a fraction of the image's short side,
+
+then aggregates the per-view probabilities: disease classes take their
+maximum over the views (a lesion only needs to show up in one tile) and the
+remaining classes their mean.  Per-tile disease scores are also painted onto
+a coarse grid, which is returned as a heatmap.
+
+A tile budget bounds latency.  Scales are added coarsest first, each taking
+at most an equal share of what is left of the budget; a scale whose full
+grid does not fit its share is cut to an evenly spread subset of positions,
+so one fine scale cannot silently reduce tiled mode to the global view.
+"""
+import math
+from io import BytesIO
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+Box = Tuple[int, int, int, int]
+
+DEFAULT_SCALES = (0.5,)
+DEFAULT_OVERLAP = 0.25
+DEFAULT_BUDGET = 16
+HEATMAP_GRID = 8
+
+
+def _spread(length: int, side: int, count: int) -> List[int]:
+    if side >= length:
+        return [0]
+    if count == 1:
+        return [(length - side) // 2]
+    # spread evenly so the last tile ends exactly at the border
+    return [round(i * (length - side) / (count - 1)) for i in range(count)]
+
+
+def _positions(length: int, side: int, stride: int) -> List[int]:
+    if side >= length:
+        return [0]
+    return _spread(length, side, math.ceil((length - side) / stride) + 1)
+
+
+def _fit(nx: int, ny: int, room: int) -> Tuple[int, int]:
+    """Largest grid of at most `room` tiles with about the aspect of nx x ny."""
+    f = math.sqrt(room / (nx * ny))
+    fx, fy = max(1, min(nx, int(nx * f))), max(1, min(ny, int(ny * f)))
+    # flooring both sides can leave room for one more row or column
+    if (fx + 1) * fy <= room and fx < nx:
+        fx += 1
+    if fx * (fy + 1) <= room and fy < ny:
+        fy += 1
+    return fx, fy
+
+
+def plan_tiles(width: int, height: int, scales: Sequence[float] = DEFAULT_SCALES,
+               overlap: float = DEFAULT_OVERLAP, budget: int = DEFAULT_BUDGET) -> List[Box]:
+    """Crop boxes (left, top, right, bottom); the first one is always the global view."""
+    boxes = [(0, 0, width, height)]
+    short = min(width, height)
+    ordered = sorted(scales, reverse=True)
+    for i, scale in enumerate(ordered):
+        side = max(1, int(short * scale))
+        stride = max(1, int(side * (1 - overlap)))
+        xs = _positions(width, side, stride)
+        ys = _positions(height, side, stride)
+        room = (budget - len(boxes)) // (len(ordered) - i)
+        if room <= 0:
+            continue
+        if len(xs) * len(ys) > room:
+            nx, ny = _fit(len(xs), len(ys), room)
+            xs, ys = _spread(width, side, nx), _spread(height, side, ny)
+        boxes.extend((x, y, x + side, y + side) for y in ys for x in xs)
+    return boxes
+
+
+def load_tiles(image_bytes: bytes, size: Tuple[int, int], scales: Sequence[float] = DEFAULT_SCALES,
+               overlap: float = DEFAULT_OVERLAP, budget: int = DEFAULT_BUDGET):
+    """Decode once and cut every view; returns (float32 pixels (N, H, W, 3), boxes, (W, H)).
+
+    Boxes are in original-image pixels.  JPEGs are decoded at the smallest
+    reduction that still gives the finest tile at least `size` pixels.
+    """
+    img = Image.open(BytesIO(image_bytes))
+    full_w, full_h = img.size
+    boxes = plan_tiles(full_w, full_h, scales, overlap, budget)
+    finest = min(b[2] - b[0] for b in boxes)
+    factor = max(size) / finest
+    if factor < 1:
+        img.draft("RGB", (math.ceil(full_w * factor), math.ceil(full_h * factor)))
+    img = img.convert("RGB")
+    sx, sy = img.size[0] / full_w, img.size[1] / full_h
+
+    views = []
+    for left, top, right, bottom in boxes:
+        crop = img.crop((round(left * sx), round(top * sy), round(right * sx), round(bottom * sy)))
+        views.append(np.asarray(crop.resize(size, Image.BILINEAR), dtype=np.float32))
+    return np.stack(views), boxes, (full_w, full_h)
+
+
+def disease_indices(labels: Sequence[str]) -> List[int]:
+    return [i for i, name in enumerate(labels) if "healthy" not in name.lower()]
+
+
+def aggregate(probs: np.ndarray, boxes: Sequence[Box], image_size: Tuple[int, int],
+              labels: Sequence[str], grid: int = HEATMAP_GRID):
+    """Combine per-view probabilities; returns (probs, heatmap rows of floats or None)."""
+    probs = np.asarray(probs, dtype=np.float32)
+    disease = disease_indices(labels)
+    combined = probs.mean(axis=0)
+    if disease:
+        combined[disease] = probs[:, disease].max(axis=0)
+    combined = combined / combined.sum()
+
+    # tile disease score: total disease probability, or the top class if no
+    # label is marked healthy
+    scores = probs[:, disease].sum(axis=1) if disease else probs.max(axis=1)
+    width, height = image_size
+    cols = grid
+    rows = max(1, round(grid * height / width))
+    total = np.zeros((rows, cols), dtype=np.float32)
+    count = np.zeros((rows, cols), dtype=np.float32)
+    centers_x = (np.arange(cols) + 0.5) * width / cols
+    centers_y = (np.arange(rows) + 0.5) * height / rows
+    # skip the global view: it would paint the same value everywhere
+    for (left, top, right, bottom), score in zip(boxes[1:], scores[1:]):
+        in_x = (centers_x >= left) & (centers_x < right)
+        in_y = (centers_y >= top) & (centers_y < bottom)
+        cell = np.outer(in_y, in_x)
+        total[cell] += score
+        count[cell] += 1
+
+    heatmap = [
+        [round(float(total[r, c] / count[r, c]), 3) if count[r, c] else None for c in range(cols)]
+        for r in range(rows)
+    ]
+    return combined, heatmap
@@ -0,0 +1,115 @@
+"""Optional ASGI middleware that records live traffic as JSONL for loadgen.py.
+
+One line per HTTP request:
+
+    {"ts": 1760000000.123, "method": "POST", "path": "/predict", "query": "",
+     "status": 200, "duration_ms": 41.2, "request_bytes": 183422,
+     "response_bytes": 171, "content_type": "multipart/form-data; boundary=...",
+     "worker": "0", "payload": "3f/3f9c...e1"}
+
+`payload` is only present when payload capture is on: request bodies are
+stored once per distinct content under `<payload_dir>/<aa>/<sha256>`, so a
+capture can be replayed byte-for-byte.  Lines are written with a single
+O_APPEND write, which keeps records from several workers intact in one file.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import Optional
+
+MAX_PAYLOAD_BYTES = 20 * 1024 * 1024
+
+
+def payload_path(payload_dir: str, ref: str) -> str:
+    return os.path.join(payload_dir, *ref.split("/"))
+
+
+def _store_payload(payload_dir: str, data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    ref = f"{digest[:2]}/{digest}"
+    path = payload_path(payload_dir, ref)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return ref
+
+
+class TrafficRecorder:
+    def __init__(self, app, path: str, payload_dir: Optional[str] = None,
+                 max_payload: int = MAX_PAYLOAD_BYTES):
+        self.app = app
+        self.path = path
+        self.payload_dir = payload_dir
+        self.max_payload = max_payload
+        self._fd = None
+
+    def _write(self, entry: dict, body: Optional[bytes]) -> None:
+        if body:
+            entry["payload"] = _store_payload(self.payload_dir, body)
+        if self._fd is None:
+            # opened lazily so every forked worker gets its own descriptor
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._fd, (json.dumps(entry) + "\n").encode("utf-8"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        ts = time.time()
+        start = time.perf_counter()
+        capture = self.payload_dir is not None and scope["method"] in ("POST", "PUT")
+        chunks = []
+        received = sent = 0
+        status = 500
+        # stamped when the last body chunk goes out: Starlette runs background
+        # tasks (e.g. thumbnails) after that, still inside the app call
+        finished = None
+
+        async def recording_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                received += len(chunk)
+                if capture and received <= self.max_payload:
+                    chunks.append(chunk)
+            return message
+
+        async def recording_send(message):
+            nonlocal sent, status, finished
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = time.perf_counter()
+
+        try:
+            await self.app(scope, recording_receive, recording_send)
+        finally:
+            headers = dict(scope.get("headers") or [])
+            entry = {
+                "ts": round(ts, 3),
+                "method": scope["method"],
+                "path": scope["path"],
+                "query": scope.get("query_string", b"").decode("latin-1"),
+                "status": status,
+                "duration_ms": round(((finished or time.perf_counter()) - start) * 1000, 3),
+                "request_bytes": received,
+                "response_bytes": sent,
+                "content_type": headers.get(b"content-type", b"").decode("latin-1"),
+                "worker": os.environ.get("WORKER_ID", "0"),
+            }
+            body = b"".join(chunks) if capture and received <= self.max_payload else None
+            try:
+                # hashing and writing a multi-MB upload stays off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self._write, entry, body)
+            except OSError as e:
+                print(f"Traffic recorder: could not write record: {e}")
@@ -9,6 +9,8 @@ from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 import numpy as np
 
+from dataset_cache import load_split
+
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 IMG_SIZE = 224
@@ -17,6 +19,7 @@ EPOCHS = 50
 LEARNING_RATE = 0.001
 
 dataset_path = 'tomato'
+cache_path = 'dataset_cache'
 model_output_path = 'model/tomato_model'
 
 if not os.path.exists('model'):
@@ -36,18 +39,50 @@ train_datagen = ImageDataGenerator(
 
 val_datagen = ImageDataGenerator(rescale=1.0/255.0)
 
-train_generator = train_datagen.flow_from_directory(
-    os.path.join(dataset_path, 'train'),
-    target_size=(IMG_SIZE, IMG_SIZE),
-    batch_size=BATCH_SIZE,
-    class_mode='categorical'
+
+
+class CachedSequence(keras.utils.Sequence):
+    """Batches sliced from the memory-mapped dataset cache (see dataset_cache.py)."""
+
+    def __init__(self, split, datagen, batch_size, shuffle):
+        super().__init__()
+        self.split = split
+        self.datagen = datagen
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_classes = split.num_classes
+        self.class_indices = {name: i for i, name in enumerate(split.class_names)}
+        self.order = np.arange(len(split))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.split) / self.batch_size))
+
+    def __getitem__(self, i):
+        idx = self.order[i * self.batch_size:(i + 1) * self.batch_size]
+        x = self.split.images(idx).astype(np.float32)
+        for j in range(len(x)):
+            x[j] = self.datagen.standardize(self.datagen.random_transform(x[j]))
+        y = keras.utils.to_categorical(self.split.labels[idx], self.num_classes)
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+
+train_generator = CachedSequence(
+    load_split(dataset_path, 'train', cache_dir=cache_path, image_size=IMG_SIZE),
+    train_datagen,
+    BATCH_SIZE,
+    shuffle=True
 )
 
-validation_generator = val_datagen.flow_from_directory(
-    os.path.join(dataset_path, 'val'),
-    target_size=(IMG_SIZE, IMG_SIZE),
-    batch_size=BATCH_SIZE,
-    class_mode='categorical'
+validation_generator = CachedSequence(
+    load_split(dataset_path, 'val', cache_dir=cache_path, image_size=IMG_SIZE),
+    val_datagen,
+    BATCH_SIZE,
+    shuffle=False
 )
 
 base_model = MobileNetV2(
@@ -1,6 +1,9 @@
 import os
+import sys
+import time
 from io import BytesIO
 from collections import deque
+from contextlib import contextmanager
 
 import numpy as np
 from PIL import Image
@@ -31,10 +34,24 @@ def preprocess_image(image_bytes: bytes,
 
     Returns a numpy array shaped (1, H, W, 3) with the requested dtype.
     """
+    arr = load_pixels(image_bytes, target_size)
+
+    out = pixels_to_input(arr, dtype, quantization)
+    out = np.expand_dims(out, axis=0)
+    return out
+
+
+def load_pixels(image_bytes: bytes, target_size: tuple = (224, 224)) -> np.ndarray:
+    """Decode and resize to (H, W, 3) float32 RGB in [0, 255], before any model scaling."""
     img = Image.open(BytesIO(image_bytes)).convert("RGB")
     img = img.resize(target_size, Image.BILINEAR)
-    arr = np.asarray(img).astype(np.float32)
+    return np.asarray(img).astype(np.float32)
+
 
+def pixels_to_input(arr: np.ndarray,
+                    dtype: np.dtype = np.float32,
+                    quantization: tuple | None = None) -> np.ndarray:
+    """Map float32 RGB pixels in [0, 255] (any leading shape) to model input values."""
     # MobileNetV2 expects inputs in [-1, 1]
     if np.issubdtype(dtype, np.floating):
         arr = (arr / 127.5) - 1.0
@@ -52,13 +69,12 @@ def preprocess_image(image_bytes: bytes,
                 out = q.astype(dtype)
         else:
             out = arr.astype(dtype)
-
-    out = np.expand_dims(out, axis=0)
     return out
 
 
 def softmax(x: np.ndarray) -> np.ndarray:
-    e_x = np.exp(x - np.max(x))
+    """Along the last axis, so a (batch, classes) array is normalised row by row."""
+    e_x = np.exp(x - np.max(x, axis=-1, keepdims=True))
     return e_x / np.sum(e_x, axis=-1, keepdims=True)
 
 
@@ -86,3 +102,87 @@ class PredictionSmoother:
 
     def reset(self) -> None:
         self.buffer.clear()
+
+
+def peak_rss_mb() -> float | None:
+    """Highest resident set size this process has reached, in MB (None on Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb(pid: int | str = "self") -> float | None:
+    """Resident set size in MB, or None where it can't be read.
+
+    Other processes can only be measured on Linux; for this process the peak
+    RSS stands in elsewhere, as the best available figure.
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    return peak_rss_mb() if pid == "self" else None
+
+
+def current_pss_mb(pid: int | str = "self") -> float | None:
+    """Proportional set size in MB: shared pages are split between their users.
+
+    Summing PSS over processes gives their true combined footprint, which RSS
+    overcounts.  Linux only (/proc/<pid>/smaps_rollup); None elsewhere.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class StartupProfile:
+    """Wall time and RSS after each named startup phase.
+
+    Usage: `with profile.phase("model_load"): ...`, or `profile.record(name, since)`
+    for a phase that started before the profile existed (e.g. module imports).
+    """
+    def __init__(self, started_at: float | None = None):
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.phases: list = []
+        self.total_ms: float | None = None
+
+    def record(self, name: str, since: float) -> None:
+        rss = current_rss_mb()
+        self.phases.append({
+            "phase": name,
+            "duration_ms": round((time.perf_counter() - since) * 1000, 2),
+            "rss_mb": round(rss, 1) if rss is not None else None,
+        })
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def _elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self.started_at) * 1000, 2)
+
+    def finish(self) -> None:
+        """Freeze the total at the moment startup completed; later calls keep it."""
+        if self.total_ms is None:
+            self.total_ms = self._elapsed_ms()
+
+    def as_dict(self) -> dict:
+        return {
+            "total_ms": self.total_ms if self.total_ms is not None else self._elapsed_ms(),
+            "complete": self.total_ms is not None,
+            "phases": list(self.phases),
+        }